@@ -1,11 +1,46 @@
+import asyncio
+import contextvars
 import cv2
+import dataclasses
+import gzip
+import io
+import json
+import logging
+import logging.handlers
 import numpy as np
 import google.generativeai as genai
 import os
-from PIL import Image
+import secrets
+import sqlite3
+import tempfile
+from PIL import Image, ImageOps
 import streamlit as st
 import base64
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+from types import SimpleNamespace
+from typing import NamedTuple
+from weargalaxy.hedging import HEDGE_MAX_RATE, HEDGE_PERCENTILE, Hedger
+from weargalaxy.imaging import (
+    GEMINI_IMAGE_MIME_TYPES, decode_rgb, detect_mime_type, format_payload_stats, perceptual_hash, prepare_image_for_gemini,
+)
+from weargalaxy.metrics import SIZE_BUCKETS, TOKEN_BUCKETS, AppMetrics
+from weargalaxy.ratelimit import (
+    FILE_LOCKING_AVAILABLE, RATE_LIMIT_MAX_WAIT_SECONDS, RATE_LIMIT_PATH, RATE_LIMIT_RPM, RATE_LIMIT_TPM, RateLimitExceeded,
+    TokenBucketLimiter, estimate_tokens, rate_limited,
+)
+from weargalaxy.resilience import (
+    BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, CALL_DEADLINE_SECONDS, CircuitBreaker, CircuitOpenError,
+    call_with_resilience,
+)
+from weargalaxy.singleflight import SingleFlight
 
 # --- Helper Function to Encode Image ---
 def img_to_bytes(img_path):
@@ -178,58 +213,1400 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # --- Gemini API Configuration ---
+MODEL_NAME = 'gemini-2.5-flash'
+SUGGESTION_REFRESH_SECONDS = int(os.getenv("WEAR_SUGGESTION_REFRESH_SECONDS", str(24 * 3600)))
+
+# Point the app at another Gemini-compatible endpoint (e.g. the load-test stand-in); REST only.
+GEMINI_API_ENDPOINT = os.getenv("GEMINI_API_ENDPOINT")
+GEMINI_TRANSPORT = "rest" if GEMINI_API_ENDPOINT else os.getenv("GEMINI_TRANSPORT", "grpc")
+# "record" saves every Gemini exchange to a cassette file, "replay" serves them back offline (see Cassette).
+CASSETTE_MODE = os.getenv("WEAR_CASSETTE_MODE", "").lower()
+
+@st.cache_resource(show_spinner=False)
+def get_model(api_key, model_name=MODEL_NAME):
+    """Configures the Gemini client once per process and reuses it (and its channel) across sessions.
+
+    The API key is part of the cache key, so a credential change builds a fresh client.
+    """
+    client_options = {"api_endpoint": GEMINI_API_ENDPOINT} if GEMINI_API_ENDPOINT else None
+    genai.configure(api_key=api_key, transport=GEMINI_TRANSPORT, client_options=client_options)
+    return genai.GenerativeModel(model_name)
+
 try:
-    API_KEY = os.getenv("GEMINI_API_KEY") or st.secrets.get("GEMINI_API_KEY")
-    genai.configure(api_key=API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash')
+    if CASSETTE_MODE == "replay":
+        API_KEY = os.getenv("GEMINI_API_KEY")  # replays never reach the network
+    else:
+        API_KEY = os.getenv("GEMINI_API_KEY") or st.secrets.get("GEMINI_API_KEY")
+    model = get_model(API_KEY)
 except Exception as e:
     st.error(f"FATAL ERROR: Could not configure Gemini API. Please set your GEMINI_API_KEY. Error: {e}")
     st.stop()
 
+# --- Metrics ---
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    return AppMetrics()
+
+metrics = get_metrics()
+
+# --- Gemini Call Instrumentation ---
+# USD per million tokens; defaults are gemini-2.5-flash list prices (thinking tokens bill as output).
+INPUT_PRICE_PER_MTOK = float(os.getenv("WEAR_INPUT_PRICE_PER_MTOK", "0.30"))
+OUTPUT_PRICE_PER_MTOK = float(os.getenv("WEAR_OUTPUT_PRICE_PER_MTOK", "2.50"))
+
+def request_payload_bytes(contents):
+    """Approximates the request size from its text and inline image data."""
+    if isinstance(contents, (str, dict)):
+        contents = [contents]
+    return sum(len(part["data"]) if isinstance(part, dict) else len(str(part).encode()) for part in contents)
+
+def record_gemini_call(mode, wall_seconds, ttfb_seconds, payload_bytes, usage=None, error=None):
+    """Records one upstream Gemini call: latency, time to first byte, payload size, tokens and cost.
+
+    ttfb_seconds is None for calls where it isn't measured (anything not streamed).
+    """
+    labels = {"mode": mode}
+    metrics.incr("gemini_calls", labels=labels)
+    metrics.observe("gemini_call_seconds", wall_seconds, labels)
+    if ttfb_seconds is not None:
+        metrics.observe("gemini_ttfb_seconds", ttfb_seconds, labels)
+    metrics.observe("gemini_request_bytes", payload_bytes, labels, SIZE_BUCKETS)
+    if error is not None:
+        metrics.incr("gemini_errors", labels={"mode": mode, "error": type(error).__name__})
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    output_tokens = (getattr(usage, "candidates_token_count", 0) or 0) + (getattr(usage, "thoughts_token_count", 0) or 0)
+    metrics.observe("gemini_prompt_tokens", prompt_tokens, labels, TOKEN_BUCKETS)
+    metrics.observe("gemini_output_tokens", output_tokens, labels, TOKEN_BUCKETS)
+    cost = (prompt_tokens * INPUT_PRICE_PER_MTOK + output_tokens * OUTPUT_PRICE_PER_MTOK) / 1e6
+    metrics.incr("gemini_cost_usd", cost, labels)
+
+def instrumented_attempt(make_call, mode, payload_bytes, stream=False):
+    """Wraps make_call so every attempt sent to Gemini is recorded, retries and hedge duplicates included.
+
+    Streamed attempts are recorded when their stream ends, with the time to their first chunk.
+    """
+    async def call():
+        started = time.perf_counter()
+        try:
+            response = await make_call()
+        except CassetteMiss:
+            raise  # nothing was recorded for this request, so nothing was sent
+        except BaseException as e:
+            # Cancelled attempts (deadlines, lost hedges) were still sent, so they count too.
+            record_gemini_call(mode, time.perf_counter() - started, None, payload_bytes, error=e)
+            raise
+        if stream:
+            return _instrumented_chunks(response, mode, payload_bytes, started)
+        record_gemini_call(mode, time.perf_counter() - started, None, payload_bytes, response.usage_metadata)
+        return response
+    return call
+
+async def _instrumented_chunks(chunks, mode, payload_bytes, started):
+    ttfb = None
+    usage = None
+    try:
+        async for chunk in chunks:
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            usage = getattr(chunk, "usage_metadata", None) or usage
+            yield chunk
+    except BaseException as e:
+        record_gemini_call(mode, time.perf_counter() - started, ttfb, payload_bytes, usage, error=e)
+        raise
+    record_gemini_call(mode, time.perf_counter() - started, ttfb, payload_bytes, usage)
+
+def record_rejected_call(mode, error):
+    """Counts a call the app refused to send (open breaker, rate limit, cassette miss)."""
+    metrics.incr("gemini_rejected_calls", labels={"mode": mode, "reason": type(error).__name__})
+
+def count_rejected_stream(chunks, mode):
+    """Passes streamed chunks through, counting the call as rejected if it was refused before sending."""
+    try:
+        yield from chunks
+    except REJECTED_CALL_ERRORS as e:
+        record_rejected_call(mode, e)
+        raise
+
+# --- Tracing ---
+TRACING_ENABLED = os.getenv("WEAR_TRACING_ENABLED", "1") == "1"
+# RotatingFileHandler is not safe across processes, so each process writes (and rotates) its own file:
+# "{pid}" in the path is replaced with the process id.
+TRACE_PATH = os.getenv("WEAR_TRACE_PATH", os.path.join(tempfile.gettempdir(), "weargalaxy_traces.{pid}.jsonl"))
+TRACE_MAX_BYTES = int(os.getenv("WEAR_TRACE_MAX_BYTES", str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = 3
+
+_current_span = contextvars.ContextVar("current_span", default=None)
+TRACE_RESOURCE = {"attributes": [
+    {"key": "service.name", "value": {"stringValue": "weargalaxy"}},
+    {"key": "process.pid", "value": {"intValue": str(os.getpid())}},
+]}
+
+def trace_path():
+    return TRACE_PATH.replace("{pid}", str(os.getpid()))
+
+@st.cache_resource(show_spinner=False)
+def get_trace_logger():
+    """Writes one finished span per line to a size-rotated JSONL file."""
+    logger = logging.getLogger("weargalaxy.traces")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    handler = logging.handlers.RotatingFileHandler(trace_path(), maxBytes=TRACE_MAX_BYTES, backupCount=TRACE_BACKUP_COUNT)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(handler)
+    return logger
+
+def otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+@contextmanager
+def span(name, parent=None, **attributes):
+    """Times a block as a span in the OpenTelemetry (OTLP JSON) span shape.
+
+    Spans nest through a context variable; pass `parent` to continue a trace started in an
+    earlier block (e.g. rendering the result of an analysis).
+    """
+    if not TRACING_ENABLED:
+        yield {"attributes": attributes}
+        return
+    parent = parent or _current_span.get()
+    record = {
+        "traceId": parent["traceId"] if parent else secrets.token_hex(16),
+        "spanId": secrets.token_hex(8),
+        "parentSpanId": parent["spanId"] if parent else "",
+        "name": name,
+        "kind": "SPAN_KIND_INTERNAL",
+        "startTimeUnixNano": str(time.time_ns()),
+        "status": {"code": "STATUS_CODE_OK"},
+        "attributes": attributes,  # callers may add attributes while the span is open
+    }
+    token = _current_span.set(record)
+    try:
+        yield record
+    except BaseException as e:
+        record["status"] = {"code": "STATUS_CODE_ERROR", "message": f"{type(e).__name__}: {e}"}
+        raise
+    finally:
+        _current_span.reset(token)
+        record["endTimeUnixNano"] = str(time.time_ns())
+        record["attributes"] = [{"key": key, "value": otlp_value(value)} for key, value in attributes.items()]
+        record["resource"] = TRACE_RESOURCE
+        get_trace_logger().info(json.dumps(record))
+
+# --- Prometheus Exporter ---
+# Loopback only by default: the exporter has no authentication. Set WEAR_METRICS_HOST=0.0.0.0 to scrape remotely.
+METRICS_HOST = os.getenv("WEAR_METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("WEAR_METRICS_PORT", "9464"))
+# Each process on a host exports its own metrics on the first free port from METRICS_PORT on.
+METRICS_PORT_RANGE = int(os.getenv("WEAR_METRICS_PORT_RANGE", "16"))
+metrics_log = logging.getLogger("weargalaxy.metrics")
+ACTIVE_SESSION_WINDOW_SECONDS = 300
+
+class SessionTracker:
+    """Counts sessions that reran the script recently, as Streamlit has no public session count."""
+    def __init__(self, window_seconds):
+        self.window_seconds = window_seconds
+        self._last_seen = {}  # session id -> monotonic time of its last rerun
+        self._lock = threading.Lock()
+
+    def touch(self, session_id):
+        with self._lock:
+            self._last_seen[session_id] = time.monotonic()
+
+    def active_count(self):
+        cutoff = time.monotonic() - self.window_seconds
+        with self._lock:
+            for session_id in [sid for sid, seen in self._last_seen.items() if seen < cutoff]:
+                del self._last_seen[session_id]
+            return len(self._last_seen)
+
+@st.cache_resource(show_spinner=False)
+def get_session_tracker():
+    return SessionTracker(ACTIVE_SESSION_WINDOW_SECONDS)
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def format_labels(labels, **extra):
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels.items()) + "}"
+
+def render_prometheus(snapshot):
+    """Renders a metrics snapshot in the Prometheus text exposition format."""
+    lines = []
+    typed = set()
+    for kind, suffix in (("counters", "_total"), ("gauges", "")):
+        for sample in snapshot[kind]:
+            name = f"weargalaxy_{sample['name']}{suffix}"
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {'counter' if kind == 'counters' else 'gauge'}")
+            lines.append(f"{name}{format_labels(sample['labels'])} {sample['value']}")
+    for sample in snapshot["histograms"]:
+        name = f"weargalaxy_{sample['name']}"
+        if name not in typed:
+            typed.add(name)
+            lines.append(f"# TYPE {name} histogram")
+        for bound, count in sample["buckets"]:
+            lines.append(f"{name}_bucket{format_labels(sample['labels'], le=bound)} {count}")
+        lines.append(f"{name}_sum{format_labels(sample['labels'])} {sample['sum']}")
+        lines.append(f"{name}_count{format_labels(sample['labels'])} {sample['count']}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves /metrics (Prometheus text) and /metrics.json from the process-wide metrics."""
+    def do_GET(self):
+        metrics.set_gauge("active_sessions", get_session_tracker().active_count())
+        snapshot = metrics.snapshot()
+        if self.path == "/metrics":
+            body, content_type = render_prometheus(snapshot), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, content_type = json.dumps(snapshot), "application/json"
+        else:
+            self.send_error(404)
+            return
+        payload = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would otherwise flood the Streamlit log
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_exporter():
+    """Starts the metrics HTTP server once per process; returns None if disabled or no port is free."""
+    if METRICS_PORT <= 0:
+        return None
+    for port in range(METRICS_PORT, METRICS_PORT + max(METRICS_PORT_RANGE, 1)):
+        try:
+            server = ThreadingHTTPServer((METRICS_HOST, port), MetricsHandler)
+            break
+        except OSError:
+            continue  # taken, most likely by another app process on this host
+    else:
+        metrics_log.warning(
+            "Metrics exporter disabled: no free port in %s:%d-%d", METRICS_HOST, METRICS_PORT, port
+        )
+        return None
+    metrics_log.info("Exporting metrics on http://%s:%d/metrics (pid %d)", METRICS_HOST, port, os.getpid())
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
+
+# --- Async Gemini Calls ---
+class AsyncRunner:
+    """Runs coroutines on one shared event loop so Gemini I/O doesn't occupy a thread per call.
+
+    Script threads submit the SDK's async calls here and wait on the returned futures.
+    """
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="gemini-event-loop", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        return self.submit(coro).result()
+
+    def iterate(self, coro):
+        """Runs a coroutine returning an async iterable and yields its items from the calling thread."""
+        iterator = self.run(_start_iteration(coro))
+        while True:
+            done, item = self.run(_next_item(iterator))
+            if done:
+                return
+            yield item
+
+async def _start_iteration(coro):
+    return (await coro).__aiter__()
+
+async def _next_item(iterator):
+    try:
+        # A stalled stream shouldn't hold the script thread forever.
+        return False, await asyncio.wait_for(iterator.__anext__(), CALL_DEADLINE_SECONDS)
+    except StopAsyncIteration:
+        return True, None
+
+@st.cache_resource(show_spinner=False)
+def get_async_runner():
+    return AsyncRunner()
+
+async def _iterate_in_thread(iterable):
+    iterator = iter(iterable)
+    done = object()
+    while (item := await asyncio.to_thread(next, iterator, done)) is not done:
+        yield item
+
+# --- Record/Replay Cassettes ---
+CASSETTE_PATH = os.getenv("WEAR_CASSETTE_PATH", os.path.join("cassettes", "gemini.jsonl.gz"))
+CASSETTE_LATENCY = os.getenv("WEAR_CASSETTE_LATENCY", "recorded")  # "recorded", "none" or milliseconds
+
+class CassetteMiss(Exception):
+    """Raised in replay mode for a request that was never recorded."""
+
+class ReplayResponse:
+    """Just enough of a GenerateContentResponse (or stream chunk) for the app's call sites."""
+    def __init__(self, text, usage):
+        self.text = text
+        self.parts = [text] if text else []
+        self.usage_metadata = SimpleNamespace(**usage) if usage else None
+
+def usage_to_dict(usage):
+    if usage is None:
+        return None
+    fields = ("prompt_token_count", "candidates_token_count", "thoughts_token_count", "total_token_count")
+    return {field: getattr(usage, field, 0) or 0 for field in fields}
+
+class Cassette:
+    """Records Gemini request/response pairs to a gzipped JSONL file keyed by request digest, or replays them.
+
+    Each line holds the response text (one entry per streamed chunk), token usage and the recorded
+    latency, so replays are deterministic and need no network or API key.
+    """
+    def __init__(self, path, mode, latency):
+        self.path = path
+        self.mode = mode
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._entries = {}
+        if os.path.exists(path):
+            with gzip.open(path, "rt") as cassette_file:
+                for line in cassette_file:
+                    entry = json.loads(line)
+                    self._entries[entry["digest"]] = entry
+        elif mode == "record":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    def _write(self, entry):
+        with self._lock:
+            self._entries[entry["digest"]] = entry
+            # Appending a gzip member per entry keeps the file readable as one stream.
+            with gzip.open(self.path, "at") as cassette_file:
+                cassette_file.write(json.dumps(entry) + "\n")
+
+    def _lookup(self, digest):
+        entry = self._entries.get(digest)
+        if entry is None:
+            raise CassetteMiss(f"No recorded response for request {digest[:12]}; record it with WEAR_CASSETTE_MODE=record.")
+        return entry
+
+    def _delays(self, entry):
+        """Returns (time to first chunk, delay between later chunks) for a replayed entry."""
+        if self.latency == "none":
+            return 0.0, 0.0
+        if self.latency == "recorded":
+            total, first = entry["latency"], entry["ttfb"]
+        else:
+            total = first = float(self.latency) / 1000
+        return first, max(total - first, 0) / max(len(entry["chunks"]) - 1, 1)
+
+    async def record(self, digest, call):
+        started = time.perf_counter()
+        response = await call
+        latency = time.perf_counter() - started
+        self._write({
+            "digest": digest, "chunks": [response.text if response.candidates and response.parts else ""], "usage": usage_to_dict(response.usage_metadata),
+            "latency": latency, "ttfb": latency,
+        })
+        return response
+
+    async def replay(self, digest):
+        entry = self._lookup(digest)
+        first, _ = self._delays(entry)
+        await asyncio.sleep(first)
+        return ReplayResponse("".join(entry["chunks"]), entry["usage"])
+
+    async def record_stream(self, digest, start):
+        started = time.perf_counter()
+        stream = await start
+        return self._recording_iterator(digest, stream, started)
+
+    async def _recording_iterator(self, digest, stream, started):
+        chunks, usage, ttfb = [], None, None
+        async for chunk in stream:
+            if ttfb is None:
+                ttfb = time.perf_counter() - started
+            chunks.append(chunk.text if chunk.parts else "")
+            usage = chunk.usage_metadata or usage
+            yield chunk
+        latency = time.perf_counter() - started
+        self._write({
+            "digest": digest, "chunks": chunks, "usage": usage_to_dict(usage),
+            "latency": latency, "ttfb": ttfb if ttfb is not None else latency,
+        })
+
+    async def replay_stream(self, digest):
+        entry = self._lookup(digest)
+        return self._replaying_iterator(entry)
+
+    async def _replaying_iterator(self, entry):
+        first, between = self._delays(entry)
+        await asyncio.sleep(first)
+        for index, text in enumerate(entry["chunks"]):
+            if index:
+                await asyncio.sleep(between)
+            is_last = index == len(entry["chunks"]) - 1
+            yield ReplayResponse(text, entry["usage"] if is_last else None)
+
+@st.cache_resource(show_spinner=False)
+def get_cassette():
+    if CASSETTE_MODE not in ("record", "replay"):
+        return None
+    return Cassette(CASSETTE_PATH, CASSETTE_MODE, CASSETTE_LATENCY)
+
+def generate_content_async(contents, **kwargs):
+    """Returns a coroutine for one generate_content call on the configured transport (or cassette)."""
+    cassette = get_cassette()
+    if cassette is not None and cassette.mode == "replay":
+        return cassette.replay(request_digest(contents, **kwargs))
+    if GEMINI_TRANSPORT == "rest":
+        # The SDK's async client needs gRPC; over REST the blocking call runs on a worker thread instead.
+        call = asyncio.to_thread(model.generate_content, contents, **kwargs)
+    else:
+        call = model.generate_content_async(contents, **kwargs)
+    if cassette is not None:
+        return cassette.record(request_digest(contents, **kwargs), call)
+    return call
+
+async def _start_chat_stream(history, prompt):
+    chat = model.start_chat(history=history)
+    if GEMINI_TRANSPORT == "rest":
+        response = await asyncio.to_thread(chat.send_message, prompt, stream=True)
+        return _iterate_in_thread(response)
+    return await chat.send_message_async(prompt, stream=True)
+
+async def send_chat_message_async(history, prompt):
+    """Starts a streamed chat turn from `history` and returns an async iterable of its chunks."""
+    cassette = get_cassette()
+    if cassette is None:
+        return await _start_chat_stream(history, prompt)
+    digest = request_digest([part for turn in history for part in turn['parts']] + [prompt], stream=True)
+    if cassette.mode == "replay":
+        return await cassette.replay_stream(digest)
+    return await cassette.record_stream(digest, _start_chat_stream(history, prompt))
+
+# --- Rate Limiting ---
+@st.cache_resource(show_spinner=False)
+def get_rate_limiter():
+    if RATE_LIMIT_RPM <= 0 or RATE_LIMIT_TPM <= 0 or CASSETTE_MODE == "replay" or not FILE_LOCKING_AVAILABLE:
+        return None
+    return TokenBucketLimiter(RATE_LIMIT_PATH, RATE_LIMIT_RPM, RATE_LIMIT_TPM, RATE_LIMIT_MAX_WAIT_SECONDS, metrics)
+
+# --- Resilient Gemini Calls ---
+@st.cache_resource(show_spinner=False)
+def get_circuit_breaker():
+    return CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS, metrics)
+
+# Raised instead of sending a call, so they count as rejected calls rather than Gemini calls.
+REJECTED_CALL_ERRORS = (CircuitOpenError, RateLimitExceeded, CassetteMiss)
+
+# --- Hedged Requests ---
+HEDGE_ENABLED = os.getenv("WEAR_HEDGE_ENABLED", "0") == "1"
+
+@st.cache_resource(show_spinner=False)
+def get_hedger():
+    return Hedger(HEDGE_PERCENTILE, HEDGE_MAX_RATE, metrics=metrics)
+
+# --- Single-Flight Coalescing ---
+def request_digest(contents, **kwargs):
+    """Digests a generate_content request (model, prompt text, image bytes and options)."""
+    digest = hashlib.sha256(MODEL_NAME.encode())
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, dict):
+            digest.update(part["mime_type"].encode())
+            digest.update(part["data"])
+        else:
+            digest.update(str(part).encode())
+        digest.update(b"\0")
+    digest.update(repr(sorted(kwargs.items())).encode())
+    return digest.hexdigest()
+
+@st.cache_resource(show_spinner=False)
+def get_single_flight():
+    return SingleFlight(metrics)
+
+def generate(contents, hedge=False, mode="Other", **kwargs):
+    """Calls generate_content_async on the shared event loop and waits for the response.
+
+    Identical requests already in flight anywhere in the process share that call. With hedge=True a
+    slow call may be duplicated (see Hedger); only use it for idempotent calls. Each attempt sent to
+    Gemini is recorded in the metrics under `mode`; a coalesced waiter sent nothing and records nothing.
+    """
+    payload_bytes = request_payload_bytes(contents)
+
+    def make_call():
+        return generate_content_async(contents, **kwargs)
+    make_call = rate_limited(instrumented_attempt(make_call, mode, payload_bytes), contents, get_rate_limiter())
+
+    breaker = get_circuit_breaker()
+    if hedge:
+        hedger = get_hedger()
+        resilient_call = lambda: call_with_resilience(lambda: hedger.run(make_call), breaker, metrics=metrics)
+    else:
+        resilient_call = lambda: call_with_resilience(make_call, breaker, metrics=metrics)
+    key = request_digest(contents, **kwargs)
+    try:
+        response, _ = get_async_runner().run(get_single_flight().run(key, resilient_call))
+    except REJECTED_CALL_ERRORS as e:
+        record_rejected_call(mode, e)
+        raise
+    return response
+
 # --- Initialize Session State ---
+if 'session_id' not in st.session_state:
+    st.session_state['session_id'] = uuid.uuid4().hex
 if 'analysis_text' not in st.session_state:
     st.session_state['analysis_text'] = "Analysis will appear here."
+if 'payload_stats' not in st.session_state:
+    st.session_state['payload_stats'] = None
+if 'analysis_jobs' not in st.session_state:
+    st.session_state['analysis_jobs'] = []
+if 'speculative_job' not in st.session_state:
+    st.session_state['speculative_job'] = None
 if "messages" not in st.session_state:
     st.session_state.messages = []
 if "chat" not in st.session_state:
     st.session_state.chat = None
 
-# --- Core AI Functions ---
-def analyze_image_with_gemini(image_frame):
-    """Sends an image to Gemini and returns face shape analysis."""
-    rgb_frame = cv2.cvtColor(image_frame, cv2.COLOR_BGR2RGB)
-    pil_image = Image.fromarray(rgb_frame)
-    prompt = """
-    Analyze the face in this image. 
-    1. Determine the face shape (e.g., Oval, Round, Square, Heart).
-    2. Based on that shape, provide a concise suggestion for suitable glasses in 15 words or less.
-    Format your response exactly like this:
-    Your Face Shape Is: [Detected Shape]
-    WeAR AI's Suggestion: [Your Suggestion]
-    """
+# --- Image Ingest ---
+def read_image_payload(picture):
+    """Returns the original compressed bytes of an uploaded/captured image and their MIME type."""
+    with span("upload.read") as read_span:
+        image_bytes = picture.getvalue()
+        mime_type = detect_mime_type(image_bytes, getattr(picture, "type", None))
+        if mime_type not in GEMINI_IMAGE_MIME_TYPES:
+            # Only formats Gemini can't take inline pay for a decode and re-encode.
+            with span("cv2.imdecode", bytes=len(image_bytes)):
+                frame = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            if frame is None:
+                raise ValueError("Could not read the image. Please use a JPG or PNG file.")
+            with span("cv2.imencode"):
+                image_bytes = cv2.imencode(".jpg", frame)[1].tobytes()
+            mime_type = "image/jpeg"
+        # Attributes can only be added while the span is open; on exit they're serialized.
+        read_span["attributes"]["mime_type"] = mime_type
+    return image_bytes, mime_type
+
+# --- Upload Cache ---
+# Reruns in Upload Image mode reuse one read/preprocess per file instead of re-sending and re-decoding the original.
+UPLOAD_CACHE_MAX_ENTRIES = int(os.getenv("WEAR_UPLOAD_CACHE_SIZE", "4"))
+PREVIEW_WIDTH = 300
+PREVIEW_MAX_EDGE = 2 * PREVIEW_WIDTH  # sharp on high-DPI screens
+
+class PreparedUpload(NamedTuple):
+    """An upload read and preprocessed once: its digest, a small preview and the analysis input."""
+    digest: str
+    preview: bytes = None
+    image_bytes: bytes = None
+    mime_type: str = None
+    payload_stats: str = None
+    error: str = None
+
+def make_preview(image_bytes):
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("RGB", (PREVIEW_MAX_EDGE, PREVIEW_MAX_EDGE))
+        preview = ImageOps.exif_transpose(img).convert("RGB")
+    preview.thumbnail((PREVIEW_MAX_EDGE, PREVIEW_MAX_EDGE), Image.LANCZOS)
+    buffer = io.BytesIO()
+    preview.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+def prepare_upload(uploaded_file):
+    """Reads and preprocesses an upload; the preprocessed image doubles as the preview when it's small enough."""
+    with span("upload.prepare", file_id=uploaded_file.file_id):
+        digest = hashlib.sha256(uploaded_file.getvalue()).hexdigest()
+        try:
+            image_bytes, mime_type = read_image_payload(uploaded_file)
+            with span("image.preprocess", original_bytes=len(image_bytes)):
+                image_bytes, mime_type, stats = prepare_image_for_gemini(image_bytes, mime_type, metrics)
+        except ValueError as e:
+            return PreparedUpload(digest, error=str(e))
+        preview = image_bytes if max(stats["sent_size"]) <= PREVIEW_MAX_EDGE else make_preview(image_bytes)
+        return PreparedUpload(digest, preview, image_bytes, mime_type, format_payload_stats(stats))
+
+class UploadCache:
+    """Per-session LRU of prepared uploads, keyed by the file uploader's file_id."""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # file_id -> PreparedUpload
+
+    def get(self, uploaded_file):
+        file_id = uploaded_file.file_id
+        if file_id in self._entries:
+            metrics.incr("upload_cache_hits")
+            self._entries.move_to_end(file_id)
+            return self._entries[file_id]
+        metrics.incr("upload_cache_misses")
+        upload = prepare_upload(uploaded_file)
+        self._entries[file_id] = upload
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return upload
+
+def get_upload_cache():
+    # Lives in session state, so it goes away with the session.
+    if 'upload_cache' not in st.session_state:
+        st.session_state['upload_cache'] = UploadCache(UPLOAD_CACHE_MAX_ENTRIES)
+    return st.session_state['upload_cache']
+
+# --- Analysis Cache ---
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.getenv("WEAR_ANALYSIS_CACHE_SIZE", "512"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.getenv("WEAR_ANALYSIS_CACHE_TTL", "3600"))
+ANALYSIS_CACHE_MAX_DISTANCE = int(os.getenv("WEAR_ANALYSIS_CACHE_MAX_DISTANCE", "6"))
+
+class AnalysisCache:
+    """LRU + TTL cache of analyses, matching images whose hashes are within a Hamming distance."""
+    def __init__(self, max_entries, ttl_seconds, max_distance):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_distance = max_distance
+        self._entries = OrderedDict()  # image hash -> (stored_at, FaceAnalysis)
+        self._lock = threading.Lock()
+
+    def get(self, image_hash):
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, (stored_at, _) in self._entries.items() if now - stored_at > self.ttl_seconds]
+            for key in expired:
+                del self._entries[key]
+            if image_hash in self._entries:
+                match = image_hash
+            else:
+                distances = ((key ^ image_hash).bit_count() for key in self._entries)
+                match = next((key for key, distance in zip(self._entries, distances) if distance <= self.max_distance), None)
+            if match is None:
+                return None
+            self._entries.move_to_end(match)
+            return self._entries[match][1]
+
+    def put(self, image_hash, analysis):
+        with self._lock:
+            self._entries[image_hash] = (time.monotonic(), analysis)
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+@st.cache_resource(show_spinner=False)
+def get_analysis_cache():
+    return AnalysisCache(ANALYSIS_CACHE_MAX_ENTRIES, ANALYSIS_CACHE_TTL_SECONDS, ANALYSIS_CACHE_MAX_DISTANCE)
+
+# --- Local Face Shape Engine ---
+FACE_SHAPES = ["Oval", "Square", "Round", "Heart"]
+# The prototypes below are hand-picked, not calibrated, so by default every analysis goes to Gemini.
+# Set a threshold in [0, 1] only after checking the local confidences against labelled photos.
+LOCAL_CONFIDENCE_THRESHOLD = float(os.getenv("WEAR_LOCAL_CONFIDENCE_THRESHOLD", "inf"))
+LOCAL_ENGINE_ENABLED = LOCAL_CONFIDENCE_THRESHOLD <= 1.0
+
+# Suggestions served with local results so a confident local match needs no network call.
+DEFAULT_SUGGESTIONS = {
+    "Oval": "Most frames suit you; try wide rectangular or bold geometric frames.",
+    "Square": "Round or oval frames soften strong jawlines; avoid sharp angular styles.",
+    "Round": "Angular rectangular or square frames add definition; avoid small round frames.",
+    "Heart": "Bottom-heavy, rimless or light oval frames balance a wider forehead.",
+}
+
+# Face Mesh landmark pairs: forehead width, cheekbone width, jaw width, face length (forehead to chin).
+FACE_MEASUREMENT_PAIRS = np.array([[54, 284], [234, 454], [172, 397], [10, 152]])
+
+# Rough prototype ratios per shape: (length / cheekbones, jaw / cheekbones, forehead / cheekbones).
+FACE_SHAPE_PROTOTYPES = np.array([
+    [1.30, 0.80, 0.82],  # Oval
+    [1.15, 0.92, 0.90],  # Square
+    [1.05, 0.82, 0.84],  # Round
+    [1.25, 0.72, 0.92],  # Heart
+])
+FACE_SHAPE_TEMPERATURE = 0.004
+
+class LocalFaceShapeEngine:
+    """Classifies face shape from MediaPipe Face Mesh landmarks without leaving the process."""
+    def __init__(self):
+        # Imported here so a missing or incompatible MediaPipe only disables this engine (see classify_locally).
+        import mediapipe as mp
+        self._face_mesh = mp.solutions.face_mesh.FaceMesh(static_image_mode=True, max_num_faces=1)
+        self._lock = threading.Lock()  # FaceMesh graphs are not safe to share between threads
+
+    def classify(self, rgb_frame):
+        """Returns (shape, confidence), or (None, 0.0) when no face is found."""
+        with self._lock:
+            results = self._face_mesh.process(rgb_frame)
+        if not results.multi_face_landmarks:
+            return None, 0.0
+        height, width = rgb_frame.shape[:2]
+        landmarks = results.multi_face_landmarks[0].landmark
+        points = np.array([(lm.x, lm.y) for lm in landmarks]) * (width, height)
+        forehead, cheekbones, jaw, length = np.linalg.norm(
+            points[FACE_MEASUREMENT_PAIRS[:, 0]] - points[FACE_MEASUREMENT_PAIRS[:, 1]], axis=1
+        )
+        features = np.array([length, jaw, forehead]) / cheekbones
+        scores = -((FACE_SHAPE_PROTOTYPES - features) ** 2).sum(axis=1) / FACE_SHAPE_TEMPERATURE
+        probabilities = np.exp(scores - scores.max())
+        probabilities /= probabilities.sum()
+        best = int(probabilities.argmax())
+        return FACE_SHAPES[best], float(probabilities[best])
+
+@st.cache_resource(show_spinner=False)
+def get_local_engine():
+    return LocalFaceShapeEngine()
+
+def classify_locally(image_bytes):
+    """Runs the local engine; any failure (e.g. an incompatible MediaPipe) counts as no match."""
     try:
-        st.session_state['analysis_text'] = "Analyzing with AI..."
-        response = model.generate_content([prompt, pil_image])
-        st.session_state['analysis_text'] = response.text.strip()
-    except Exception as e:
-        st.session_state['analysis_text'] = f"API Call Failed: {str(e)}"
+        with span("image.decode"):
+            rgb_frame = decode_rgb(image_bytes, metrics)
+        with span("face_mesh.classify") as classify_span:
+            shape_name, confidence = get_local_engine().classify(rgb_frame)
+            classify_span["attributes"].update(shape=shape_name or "none", confidence=confidence)
+    except Exception:
+        metrics.incr("local_engine_errors")
+        return None, 0.0
+    return shape_name, confidence
 
-def get_suggestion_for_shape(shape_name):
-    """Sends a face shape name to Gemini and returns a suggestion."""
-    prompt = f"""
+def format_analysis(shape_name, suggestion):
+    return f"Your Face Shape Is: {shape_name}\nWeAR AI's Suggestion: {suggestion}"
+
+class FaceAnalysis(NamedTuple):
+    """Machine-readable result of a face analysis."""
+    shape: str
+    confidence: float
+    suggestion: str
+
+    @classmethod
+    def from_json(cls, text):
+        """Parses and validates Gemini's structured analysis response."""
+        try:
+            data = json.loads(text)
+            shape = data["face_shape"]
+            confidence = min(max(float(data.get("confidence", 0.0)), 0.0), 1.0)
+            suggestion = str(data["suggestion"]).strip()
+        except (ValueError, TypeError, KeyError) as e:
+            raise ValueError(f"Unexpected analysis response: {e}")
+        if shape not in FACE_SHAPES:
+            raise ValueError(f"Unexpected face shape in analysis response: {shape}")
+        return cls(shape, confidence, suggestion)
+
+    def to_text(self):
+        return format_analysis(self.shape, self.suggestion)
+
+# --- Prompt Templates ---
+ANALYSIS_PROMPT = """
+    Analyze the face in this image.
+    Determine the face shape, how confident you are (0 to 1), and a concise suggestion
+    for suitable glasses in 15 words or less.
+    """
+
+# On 2.5 models the output limit also covers thinking tokens, so it can't be cut much further; a
+# response that still runs out is retried once with TRUNCATION_RETRY_MAX_OUTPUT_TOKENS.
+ANALYSIS_MAX_OUTPUT_TOKENS = int(os.getenv("WEAR_ANALYSIS_MAX_OUTPUT_TOKENS", "512"))
+TRUNCATION_RETRY_MAX_OUTPUT_TOKENS = int(os.getenv("WEAR_TRUNCATION_RETRY_MAX_OUTPUT_TOKENS", "2048"))
+ANALYSIS_RESPONSE_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "face_shape": {"type": "STRING", "enum": FACE_SHAPES},
+        "confidence": {"type": "NUMBER"},
+        "suggestion": {"type": "STRING"},
+    },
+    "required": ["face_shape", "confidence", "suggestion"],
+}
+ANALYSIS_GENERATION_CONFIG = genai.GenerationConfig(
+    response_mime_type="application/json",
+    response_schema=ANALYSIS_RESPONSE_SCHEMA,
+    max_output_tokens=ANALYSIS_MAX_OUTPUT_TOKENS,
+)
+
+SUGGESTION_PROMPT_TEMPLATE = """
     You are a helpful and concise fashion assistant named WeAR AI. My face shape is '{shape_name}'.
     In 15 words or less, what are the best types of glasses for me?
     Format your response exactly like this:
     WeAR AI's Suggestion: [Your Suggestion]
     """
+
+PROMPT_TEMPLATES = {"analysis": ANALYSIS_PROMPT, "suggestion": SUGGESTION_PROMPT_TEMPLATE}
+
+def template_version(template):
+    """Versions a prompt template by its text, so editing a prompt invalidates its cached responses."""
+    return hashlib.sha256(template.encode()).hexdigest()[:12]
+
+# --- Response Cache ---
+RESPONSE_CACHE_PATH = os.getenv("WEAR_RESPONSE_CACHE_PATH", os.path.join(tempfile.gettempdir(), "weargalaxy_responses.sqlite3"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("WEAR_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("WEAR_RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+
+class ResponseCache:
+    """On-disk SQLite (WAL) cache of Gemini responses, shared across restarts and processes."""
+    def __init__(self, path, max_bytes, ttl_seconds):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=10)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, template TEXT, version TEXT, value TEXT,
+                size INTEGER, created_at REAL, accessed_at REAL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+        self._db.commit()
+
+    @staticmethod
+    def make_key(model_name, template, prompt, image_bytes=None, generation_config=None):
+        normalized_prompt = " ".join(prompt.split())
+        image_digest = hashlib.sha256(image_bytes).hexdigest() if image_bytes else ""
+        # The schema and output limits shape the response as much as the prompt does.
+        config_digest = hashlib.sha256(repr(generation_config).encode()).hexdigest() if generation_config else ""
+        parts = [model_name, template_version(template), normalized_prompt, image_digest, config_digest]
+        return hashlib.sha256("\0".join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            return value
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self._db.commit()
+
+    def put(self, key, template_name, value):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, template_name, template_version(PROMPT_TEMPLATES[template_name]), value, len(value.encode()), now, now),
+            )
+            self._evict(now)
+            self._db.commit()
+
+    def _evict(self, now):
+        """Drops expired rows, then least recently used rows until the cache fits in max_bytes."""
+        self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl_seconds,))
+        total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_bytes <= self.max_bytes:
+            return
+        stale_keys = []
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if total_bytes <= self.max_bytes:
+                break
+            stale_keys.append((key,))
+            total_bytes -= size
+        self._db.executemany("DELETE FROM responses WHERE key = ?", stale_keys)
+
+    def purge_stale_versions(self, templates):
+        """Deletes responses generated from older versions of the given prompt templates."""
+        with self._lock:
+            for template_name, template in templates.items():
+                self._db.execute(
+                    "DELETE FROM responses WHERE template = ? AND version != ?",
+                    (template_name, template_version(template)),
+                )
+            self._db.commit()
+
+@st.cache_resource(show_spinner=False)
+def get_response_cache():
+    cache = ResponseCache(RESPONSE_CACHE_PATH, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL_SECONDS)
+    cache.purge_stale_versions(PROMPT_TEMPLATES)
+    return cache
+
+class EmptyResponseError(Exception):
+    """Raised when Gemini answers without any text, e.g. because the prompt was blocked."""
+
+class OutputTruncatedError(EmptyResponseError):
+    """Raised when the output token limit (thinking included) ran out before Gemini finished answering."""
+
+def response_text(response):
+    """Returns a response's text, raising a clear error where the SDK's .text accessor would fail."""
+    candidates = getattr(response, "candidates", None)
+    if candidates is None:  # cassette replays carry only the recorded text
+        return response.text
+    if not candidates:
+        metrics.incr("gemini_empty_responses", labels={"finish_reason": "NO_CANDIDATES"})
+        raise EmptyResponseError("Gemini returned no answer; the request may have been blocked.")
+    candidate = candidates[0]
+    finish_reason = genai.protos.Candidate.FinishReason(candidate.finish_reason)
+    if finish_reason == genai.protos.Candidate.FinishReason.MAX_TOKENS:
+        metrics.incr("gemini_empty_responses", labels={"finish_reason": finish_reason.name})
+        raise OutputTruncatedError("Gemini ran out of output tokens before finishing its answer.")
+    if not candidate.content.parts:
+        metrics.incr("gemini_empty_responses", labels={"finish_reason": finish_reason.name})
+        raise EmptyResponseError(f"Gemini returned an empty answer (finish reason {finish_reason.name}).")
+    return response.text
+
+def generate_text_cached(template_name, prompt, contents, image_bytes=None, parse=None, refresh=False, **kwargs):
+    """Returns the response for a templated prompt, serving it from the on-disk cache when possible.
+
+    When given, parse() validates the text before it is cached and its result is returned; a cached
+    entry it rejects is dropped and fetched again. refresh=True skips the lookup and overwrites the
+    cached entry with a fresh response. A response cut off by max_output_tokens is retried once
+    with TRUNCATION_RETRY_MAX_OUTPUT_TOKENS.
+    """
+    parse = parse or (lambda text: text)
+    response_cache = get_response_cache()
+    key = response_cache.make_key(
+        MODEL_NAME, PROMPT_TEMPLATES[template_name], prompt, image_bytes, kwargs.get("generation_config")
+    )
+    text = None if refresh else response_cache.get(key)
+    if text is not None:
+        try:
+            result = parse(text)
+        except ValueError:
+            metrics.incr("response_cache_invalid")
+            response_cache.delete(key)
+        else:
+            metrics.incr("response_cache_hits")
+            return result
+    metrics.incr("response_cache_misses")
     try:
-        st.session_state['analysis_text'] = f"Getting suggestion for {shape_name} face..."
-        response = model.generate_content(prompt)
-        st.session_state['analysis_text'] = f"Your Face Shape Is: {shape_name}\n{response.text.strip()}"
+        text = response_text(generate(contents, **kwargs))
+    except OutputTruncatedError:
+        config = kwargs.get("generation_config")
+        if config is None or (config.max_output_tokens or 0) >= TRUNCATION_RETRY_MAX_OUTPUT_TOKENS:
+            raise
+        metrics.incr("gemini_truncation_retries")
+        kwargs["generation_config"] = dataclasses.replace(config, max_output_tokens=TRUNCATION_RETRY_MAX_OUTPUT_TOKENS)
+        text = response_text(generate(contents, **kwargs))
+    text = text.strip()
+    result = parse(text)
+    response_cache.put(key, template_name, text)
+    return result
+
+# --- Core AI Functions ---
+def analyze_image_with_gemini(image_bytes, mime_type, mode="Upload Image"):
+    """Sends the compressed image bytes to Gemini and returns a structured FaceAnalysis."""
+    image_part = {"mime_type": mime_type, "data": image_bytes}
+    return generate_text_cached(
+        "analysis", ANALYSIS_PROMPT, [ANALYSIS_PROMPT, image_part], image_bytes,
+        parse=FaceAnalysis.from_json, generation_config=ANALYSIS_GENERATION_CONFIG, hedge=HEDGE_ENABLED, mode=mode,
+    )
+
+class AnalysisOutcome(NamedTuple):
+    """What an image analysis produced for display, plus its trace for the render span."""
+    text: str
+    payload_stats: str = None
+    trace: dict = None
+
+def analyze_image(image_bytes, mime_type, mode, on_stage=None):
+    """Preprocesses an image, then runs the analysis tiers on it."""
+    on_stage = on_stage or (lambda stage: None)
+    on_stage("Preparing image")
+    with span("image.preprocess", original_bytes=len(image_bytes)):
+        image_bytes, mime_type, stats = prepare_image_for_gemini(image_bytes, mime_type, metrics)
+    return analyze_prepared_image(image_bytes, mime_type, format_payload_stats(stats), mode, on_stage)
+
+def analyze_prepared_image(image_bytes, mime_type, payload_stats, mode, on_stage=None):
+    """Runs the analysis tiers: perceptual-hash cache, local landmark engine, then Gemini.
+
+    Safe to run off the script thread: it never touches st.session_state. on_stage(text) is
+    called as the analysis moves between tiers.
+    """
+    on_stage = on_stage or (lambda stage: None)
+    analysis_cache = get_analysis_cache()
+    with span("image.perceptual_hash"):
+        image_hash = perceptual_hash(image_bytes)
+    cached_analysis = analysis_cache.get(image_hash)
+    if cached_analysis is not None:
+        metrics.incr("analysis_cache_hits")
+        return AnalysisOutcome(cached_analysis.to_text(), payload_stats)
+    metrics.incr("analysis_cache_misses")
+
+    if LOCAL_ENGINE_ENABLED:
+        on_stage("Measuring face shape")
+        shape_name, confidence = classify_locally(image_bytes)
+        if shape_name is not None and confidence >= LOCAL_CONFIDENCE_THRESHOLD:
+            metrics.incr("local_engine_hits")
+            analysis = FaceAnalysis(shape_name, confidence, DEFAULT_SUGGESTIONS[shape_name])
+            analysis_cache.put(image_hash, analysis)
+            return AnalysisOutcome(analysis.to_text(), payload_stats)
+        metrics.incr("local_engine_fallbacks")
+
+    on_stage("Analyzing with AI")
+    try:
+        with span("gemini.generate_content", sent_bytes=len(image_bytes)):
+            analysis = analyze_image_with_gemini(image_bytes, mime_type, mode)
+        analysis_cache.put(image_hash, analysis)
+        return AnalysisOutcome(analysis.to_text(), payload_stats)
     except Exception as e:
-        st.session_state['analysis_text'] = f"API Call Failed: {str(e)}"
+        return AnalysisOutcome(f"API Call Failed: {str(e)}", payload_stats)
+
+def run_analysis(picture, mode, on_stage=None):
+    """Reads an uploaded/captured picture and analyzes it, as one traced unit of work."""
+    with span("analysis", mode=mode) as analysis_span:
+        try:
+            image_bytes, mime_type = read_image_payload(picture)
+            outcome = analyze_image(image_bytes, mime_type, mode, on_stage)
+        except ValueError as e:
+            outcome = AnalysisOutcome(str(e))
+    return outcome._replace(trace=analysis_span)
+
+def run_upload_analysis(upload, mode, on_stage=None):
+    """Analyzes an upload the upload cache has already read and preprocessed."""
+    with span("analysis", mode=mode) as analysis_span:
+        if upload.error:
+            outcome = AnalysisOutcome(upload.error)
+        else:
+            outcome = analyze_prepared_image(upload.image_bytes, upload.mime_type, upload.payload_stats, mode, on_stage)
+    return outcome._replace(trace=analysis_span)
+
+# --- Background Jobs ---
+JOB_WORKERS = int(os.getenv("WEAR_JOB_WORKERS", "8"))
+JOB_POLL_SECONDS = float(os.getenv("WEAR_JOB_POLL_SECONDS", "0.5"))
+JOB_RETENTION_SECONDS = 600  # finished jobs nobody collected (e.g. the tab was closed) are dropped after this
+SPECULATIVE_ANALYSIS = os.getenv("WEAR_SPECULATIVE_ANALYSIS", "0") == "1"
+
+class JobCancelled(Exception):
+    """Raised inside a job at its next stage boundary after it has been cancelled."""
+
+class Job:
+    """One background analysis: its future plus a human-readable stage for progress display."""
+    def __init__(self, label):
+        self.id = uuid.uuid4().hex
+        self.label = label
+        self.stage = "Queued"
+        self.submitted_at = time.monotonic()
+        self.future = None
+        self.cancelled = False
+
+    def set_stage(self, stage):
+        # Stage changes double as cancellation points, so a cancelled job stops before its next tier.
+        if self.cancelled:
+            raise JobCancelled(self.id)
+        self.stage = stage
+
+class JobRunner:
+    """Process-wide thread pool for analyses, so the script returns immediately after a click.
+
+    Sessions keep only job IDs; results are collected from here on a later rerun.
+    """
+    def __init__(self, max_workers):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="analysis-job")
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def submit(self, label, fn, *args):
+        """Runs fn(*args, on_stage) on the pool and returns the job ID."""
+        job = Job(label)
+        # Copying the context keeps spans opened inside the job in the right trace.
+        context = contextvars.copy_context()
+        job.future = self._executor.submit(context.run, fn, *args, job.set_stage)
+        with self._lock:
+            self._purge_abandoned()
+            self._jobs[job.id] = job
+        metrics.incr("jobs_submitted")
+        return job.id
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def collect(self, job_id):
+        """Removes a finished job and returns its result (re-raising its exception, if any)."""
+        with self._lock:
+            job = self._jobs.pop(job_id)
+        return job.future.result()
+
+    def cancel(self, job_id):
+        """Drops a job; a queued job never starts and a running one stops at its next stage."""
+        with self._lock:
+            job = self._jobs.pop(job_id, None)
+        if job is not None:
+            job.cancelled = True
+            job.future.cancel()
+
+    def _purge_abandoned(self):
+        cutoff = time.monotonic() - JOB_RETENTION_SECONDS
+        for job_id in [job_id for job_id, job in self._jobs.items() if job.future.done() and job.submitted_at < cutoff]:
+            del self._jobs[job_id]
+
+# Jobs and the suggestion refresh thread call cache_resource factories without a script context, where
+# Streamlit's cache spinner raises NoSessionContext; that's why every factory here has show_spinner=False.
+@st.cache_resource(show_spinner=False)
+def get_job_runner():
+    return JobRunner(JOB_WORKERS)
+
+def submit_analysis(picture, mode):
+    """Queues an analysis of the picture and remembers its job in this session."""
+    job_id = get_job_runner().submit(f"{mode} photo", run_analysis, picture, mode)
+    st.session_state['analysis_jobs'].append(job_id)
+
+def sync_speculative_analysis(upload, mode):
+    """Starts analysing an upload before its button is clicked; cancels it if the upload changes.
+
+    The in-flight job is remembered per session by the file's digest, so a click on the same
+    file picks it up instead of starting over.
+    """
+    speculation = st.session_state.get('speculative_job')
+    digest = upload.digest if upload else None
+    if speculation and speculation['digest'] == digest:
+        return
+    if speculation and speculation['job_id']:
+        get_job_runner().cancel(speculation['job_id'])
+        metrics.incr("speculative_analyses", labels={"outcome": "cancelled"})
+    st.session_state['speculative_job'] = None
+    if digest:
+        job_id = get_job_runner().submit(f"{mode} photo", run_upload_analysis, upload, mode)
+        st.session_state['speculative_job'] = {'digest': digest, 'job_id': job_id}
+
+def submit_uploaded_analysis(upload, mode):
+    """Hands over the speculative job for this upload if there is one, otherwise queues a new one."""
+    speculation = st.session_state.get('speculative_job')
+    if speculation and speculation['job_id'] and get_job_runner().get(speculation['job_id']) is not None:
+        st.session_state['analysis_jobs'].append(speculation['job_id'])
+        speculation['job_id'] = None  # keep the digest so the same upload isn't speculated on again
+        metrics.incr("speculative_analyses", labels={"outcome": "used"})
+    else:
+        job_id = get_job_runner().submit(f"{mode} photo", run_upload_analysis, upload, mode)
+        st.session_state['analysis_jobs'].append(job_id)
+
+def apply_analysis_outcome(outcome):
+    st.session_state['analysis_text'] = outcome.text
+    st.session_state['payload_stats'] = outcome.payload_stats
+    st.session_state['trace_parent'] = outcome.trace
+
+def collect_finished_jobs():
+    """Moves finished job results into the session, in submission order. Returns True if any finished."""
+    runner = get_job_runner()
+    collected = False
+    for job_id in list(st.session_state['analysis_jobs']):
+        job = runner.get(job_id)
+        if job is None:  # dropped by the runner, e.g. after a server restart
+            st.session_state['analysis_jobs'].remove(job_id)
+            continue
+        if not job.future.done():
+            break  # keep results in order: a later photo never overwrites an earlier one's result
+        st.session_state['analysis_jobs'].remove(job_id)
+        try:
+            apply_analysis_outcome(runner.collect(job_id))
+        except Exception as e:
+            apply_analysis_outcome(AnalysisOutcome(f"API Call Failed: {str(e)}"))
+        collected = True
+    return collected
+
+@st.fragment(run_every=JOB_POLL_SECONDS)
+def render_pending_jobs():
+    """Shows progress for queued analyses and reruns the whole app once one finishes."""
+    if collect_finished_jobs():
+        st.rerun()
+    runner = get_job_runner()
+    for position, job_id in enumerate(st.session_state['analysis_jobs'], start=1):
+        job = runner.get(job_id)
+        if job is not None:
+            elapsed = time.monotonic() - job.submitted_at
+            st.caption(f"⏳ {job.label} ({position} of {len(st.session_state['analysis_jobs'])}): {job.stage}… {elapsed:.0f}s")
+
+def build_suggestion_prompt(shape_name):
+    return SUGGESTION_PROMPT_TEMPLATE.format(shape_name=shape_name)
+
+def parse_suggestion(text):
+    """Strips the "WeAR AI's Suggestion:" label Gemini is asked to prefix its answer with."""
+    label, separator, suggestion = text.partition(":")
+    if separator and "suggestion" in label.lower():
+        text = suggestion
+    if not text.strip():
+        raise ValueError("Empty suggestion response")
+    return text.strip()
+
+class SuggestionTable:
+    """Per-shape suggestions served from memory and refreshed from Gemini on a background thread.
+
+    Seeded with DEFAULT_SUGGESTIONS so lookups never wait on the network, even right after startup.
+    """
+    def __init__(self, shapes, refresh_seconds):
+        self.shapes = shapes
+        self.refresh_seconds = refresh_seconds
+        self._suggestions = dict(DEFAULT_SUGGESTIONS)
+        self._thread = threading.Thread(target=self._refresh_forever, name="suggestion-refresh", daemon=True)
+        self._thread.start()
+
+    def get(self, shape_name):
+        return self._suggestions[shape_name]
+
+    def _refresh_forever(self):
+        refresh = False  # the first pass may reuse fresh responses from the on-disk cache
+        while True:
+            for shape_name in self.shapes:
+                prompt = build_suggestion_prompt(shape_name)
+                try:
+                    # Swapping a single dict entry is atomic, so readers never need a lock.
+                    self._suggestions[shape_name] = generate_text_cached(
+                        "suggestion", prompt, prompt, parse=parse_suggestion, refresh=refresh, mode="Manual Input"
+                    )
+                    metrics.incr("suggestion_refreshes")
+                except Exception:
+                    metrics.incr("suggestion_refresh_failures")  # keep serving the previous suggestion
+            refresh = True
+            time.sleep(self.refresh_seconds)
+
+@st.cache_resource(show_spinner=False)
+def get_suggestion_table():
+    return SuggestionTable(FACE_SHAPES, SUGGESTION_REFRESH_SECONDS)
+
+def get_suggestion_for_shape(shape_name):
+    """Shows the suggestion for a face shape from the in-memory suggestion table."""
+    suggestion = get_suggestion_table().get(shape_name)
+    st.session_state['analysis_text'] = format_analysis(shape_name, suggestion)
+
+def stream_text(response):
+    """Yields the text of each streamed response chunk as it arrives."""
+    for chunk in response:
+        if chunk.parts:
+            yield chunk.text
+
+# --- Chat Context ---
+CHAT_MAX_TURNS = int(os.getenv("WEAR_CHAT_MAX_TURNS", "6"))
+CHAT_TOKEN_BUDGET = int(os.getenv("WEAR_CHAT_TOKEN_BUDGET", "2000"))
+CHAT_TURN_BUCKETS = (1, 2, 4, 6, 8, 12, 16, 24, 32)
+class ChatContext:
+    """Chat history that keeps the last CHAT_MAX_TURNS turns verbatim and folds older ones into a summary."""
+    def __init__(self, system_instruction, max_turns=CHAT_MAX_TURNS, token_budget=CHAT_TOKEN_BUDGET):
+        self.system_instruction = system_instruction
+        self.max_turns = max_turns
+        self.token_budget = token_budget
+        self.summary = ""
+        self.turns = []  # (user text, model text) pairs, oldest first
+
+    def history(self):
+        history = [
+            {'role': 'user', 'parts': [self.system_instruction]},
+            {'role': 'model', 'parts': ["Okay, I understand. I am the WeAR AI, ready to assist with all questions about eyeglass frames."]}
+        ]
+        if self.summary:
+            history.append({'role': 'user', 'parts': [f"Summary of our conversation so far: {self.summary}"]})
+            history.append({'role': 'model', 'parts': ["Thanks, I'll keep that in mind."]})
+        for user_text, model_text in self.turns:
+            history.append({'role': 'user', 'parts': [user_text]})
+            history.append({'role': 'model', 'parts': [model_text]})
+        return history
+
+    def estimated_tokens(self, prompt=""):
+        texts = [part for turn in self.history() for part in turn['parts']]
+        return sum(estimate_tokens(text) for text in texts) + estimate_tokens(prompt)
+
+    def fit_to_budget(self, prompt):
+        """Folds the oldest turns into the summary once the context exceeds the turn or token limits.
+
+        Folding goes down to half of each limit, so the blocking summary call happens every few
+        turns instead of before every reply.
+        """
+        over_turns = len(self.turns) > self.max_turns
+        over_budget = self.estimated_tokens(prompt) > self.token_budget
+        if not (over_turns or over_budget):
+            return
+        fold_count = max(len(self.turns) - self.max_turns // 2, 0) if over_turns else 0
+        if over_budget:
+            budget_left = self.token_budget // 2 - self.estimated_tokens(prompt)
+            budget_left += sum(estimate_tokens(user_text) + estimate_tokens(model_text) for user_text, model_text in self.turns[:fold_count])
+            for user_text, model_text in self.turns[fold_count:-1]:
+                if budget_left >= 0:
+                    break
+                budget_left += estimate_tokens(user_text) + estimate_tokens(model_text)
+                fold_count += 1
+        if fold_count == 0:
+            return
+        folded, self.turns = self.turns[:fold_count], self.turns[fold_count:]
+        transcript = "\n".join(f"User: {user_text}\nWeAR AI: {model_text}" for user_text, model_text in folded)
+        summary_prompt = (
+            f"Summarize this conversation about eyeglasses in under 100 words, keeping the user's "
+            f"face shape, preferences and any frames already recommended.\n"
+            f"Earlier summary: {self.summary or 'None'}\n{transcript}"
+        )
+        try:
+            response = generate(summary_prompt, mode="Chatbot")
+            self.summary = response_text(response).strip()
+            metrics.incr("chat_summaries")
+        except Exception:
+            # Losing the oldest turns is better than letting every later turn grow without bound.
+            metrics.incr("chat_summary_failures")
+
+    def send_message(self, prompt):
+        """Sends a prompt with the bounded history and returns an iterator over the streamed chunks."""
+        with span("chat.fit_context"):
+            self.fit_to_budget(prompt)
+        metrics.observe("chat_history_turns", len(self.turns), buckets=CHAT_TURN_BUCKETS)
+        metrics.observe("chat_context_tokens", self.estimated_tokens(prompt), buckets=TOKEN_BUCKETS)
+        history = self.history()
+        contents = [part for turn in history for part in turn['parts']] + [prompt]
+        make_call = rate_limited(
+            instrumented_attempt(
+                lambda: send_chat_message_async(history, prompt), "Chatbot", request_payload_bytes(contents), stream=True
+            ),
+            contents, get_rate_limiter(),
+        )
+        chunks = get_async_runner().iterate(call_with_resilience(make_call, get_circuit_breaker(), metrics=metrics))
+        return count_rejected_stream(chunks, "Chatbot")
+
+    def record_turn(self, prompt, reply):
+        self.turns.append((prompt, reply))
+
+# --- Admin View ---
+ADMIN_TOKEN = os.getenv("WEAR_ADMIN_TOKEN")
+INPUT_MODES = ("Webcam", "Upload Image", "Manual Input", "Chatbot")
+
+def summarize_gemini_calls(snapshot):
+    """Builds one row of per-mode call statistics for the admin view from a metrics snapshot."""
+    counters = {(c["name"], c["labels"].get("mode")): c["value"] for c in snapshot["counters"] if not c["labels"].get("error")}
+    errors, rejected = Counter(), Counter()
+    for c in snapshot["counters"]:
+        if c["name"] == "gemini_errors":
+            errors[c["labels"]["mode"]] += c["value"]
+        elif c["name"] == "gemini_rejected_calls":
+            rejected[c["labels"]["mode"]] += c["value"]
+    histograms = {(h["name"], h["labels"].get("mode")): h for h in snapshot["histograms"]}
+    rows = []
+    for mode in INPUT_MODES:
+        if ("gemini_calls", mode) not in counters and not rejected[mode]:
+            continue
+        row = {"mode": mode, "calls": counters.get(("gemini_calls", mode), 0), "errors": errors[mode], "rejected": rejected[mode]}
+        for name, column in (("gemini_call_seconds", "latency"), ("gemini_ttfb_seconds", "ttfb")):
+            for q in (0.5, 0.95):
+                row[f"{column} p{q * 100:.0f} (s)"] = metrics.quantile(name, q, {"mode": mode})
+        row["prompt tokens"] = histograms.get(("gemini_prompt_tokens", mode), {}).get("sum", 0)
+        row["output tokens"] = histograms.get(("gemini_output_tokens", mode), {}).get("sum", 0)
+        row["request MB"] = histograms.get(("gemini_request_bytes", mode), {}).get("sum", 0) / 1e6
+        row["cost (USD)"] = round(counters.get(("gemini_cost_usd", mode), 0), 4)
+        rows.append(row)
+    return rows
+
+def render_admin_view():
+    """Shows per-call Gemini statistics and a JSON export in the sidebar."""
+    snapshot = metrics.snapshot()
+    with st.sidebar:
+        st.header("Gemini Calls")
+        st.dataframe(summarize_gemini_calls(snapshot), hide_index=True)
+        st.subheader("Counters")
+        st.dataframe(snapshot["counters"], hide_index=True)
+        st.download_button(
+            "Download metrics (JSON)", json.dumps(snapshot, indent=2),
+            file_name="weargalaxy-metrics.json", mime="application/json",
+        )
 
 # --- UI Layout ---
+get_suggestion_table()  # starts generating the per-shape suggestions as soon as the process serves its first page
+start_metrics_exporter()
+get_session_tracker().touch(st.session_state['session_id'])
 
 # --- START: Injected Navbar HTML with Custom Logo ---
 LOGO_PATH = "logo.png"
@@ -265,10 +1642,11 @@ st.write("---")
 
 mode = st.radio(
     "Choose your input method:",
-    ("Webcam", "Upload Image", "Manual Input", "Chatbot"),
+    INPUT_MODES,
     horizontal=True,
     label_visibility="collapsed"
 )
+metrics.incr("reruns", labels={"mode": mode})
 
 # --- Logic for Analysis Modes (Webcam, Upload, Manual) ---
 if mode != "Chatbot":
@@ -282,21 +1660,21 @@ if mode != "Chatbot":
             if picture:
                 st.write("Photo Captured! Click 'Analyze Photo' to proceed.")
                 if st.button("Analyze Photo"):
-                    file_bytes = np.asarray(bytearray(picture.read()), dtype=np.uint8)
-                    image_to_analyze = cv2.imdecode(file_bytes, 1)
-                    analyze_image_with_gemini(image_to_analyze)
+                    submit_analysis(picture, mode)
 
         elif mode == "Upload Image":
             uploaded_file = st.file_uploader("Choose an image...", type=["jpg", "jpeg", "png"], label_visibility="collapsed")
-            if uploaded_file:
-                st.image(uploaded_file, caption="Uploaded Image", width=300)
+            upload = get_upload_cache().get(uploaded_file) if uploaded_file else None
+            if SPECULATIVE_ANALYSIS:
+                sync_speculative_analysis(upload, mode)
+            if upload:
+                if upload.preview:
+                    st.image(upload.preview, caption="Uploaded Image", width=PREVIEW_WIDTH)
                 if st.button("Analyze Uploaded Image"):
-                    file_bytes = np.asarray(bytearray(uploaded_file.read()), dtype=np.uint8)
-                    image_to_analyze = cv2.imdecode(file_bytes, 1)
-                    analyze_image_with_gemini(image_to_analyze)
+                    submit_uploaded_analysis(upload, mode)
 
         elif mode == "Manual Input":
-            face_shapes = ["Select a Shape", "Oval", "Square", "Round", "Heart"]
+            face_shapes = ["Select a Shape"] + FACE_SHAPES
             selected_shape = st.selectbox(
                 "What is your face shape?",
                 face_shapes,
@@ -305,9 +1683,15 @@ if mode != "Chatbot":
             if selected_shape != "Select a Shape":
                 get_suggestion_for_shape(selected_shape)
 
-    with col2:
+    collect_finished_jobs()
+    trace_parent = st.session_state.pop('trace_parent', None)
+    with col2, span("render.analysis", parent=trace_parent) if trace_parent else nullcontext():
         st.header("AI Analysis")
         st.markdown(f"**Analysis Result:**\n```\n{st.session_state['analysis_text']}\n```")
+        if mode != "Manual Input" and st.session_state['payload_stats']:
+            st.caption(st.session_state['payload_stats'])
+        if st.session_state['analysis_jobs']:
+            render_pending_jobs()
 
 # --- Logic for Chatbot Mode ---
 elif mode == "Chatbot":
@@ -319,10 +1703,7 @@ elif mode == "Chatbot":
         and what frames are suitable for different face shapes. You MUST politely refuse to answer any question that is 
         not related to eyeglasses. If asked an off-topic question, say something like, 'I am the WeAR AI assistant 
         and my expertise is limited to eyeglass frames. How can I help you with glasses today?'"""
-        st.session_state.chat = model.start_chat(history=[
-            {'role': 'user', 'parts': [system_instruction]},
-            {'role': 'model', 'parts': ["Okay, I understand. I am the WeAR AI, ready to assist with all questions about eyeglass frames."]}
-        ])
+        st.session_state.chat = ChatContext(system_instruction)
         st.session_state.messages = [{"role": "assistant", "content": "Hello! I am the WeAR AI. How can I help you find the perfect glasses frames today?"}]
 
     for message in st.session_state.messages:
@@ -334,10 +1715,16 @@ elif mode == "Chatbot":
             st.markdown(prompt)
         st.session_state.messages.append({"role": "user", "content": prompt})
 
-        with st.spinner("Thinking..."):
-            response = st.session_state.chat.send_message(prompt)
-            with st.chat_message("assistant"):
-                st.markdown(response.text)
-        st.session_state.messages.append({"role": "assistant", "content": response.text})
-
+        with st.chat_message("assistant"), span("chat.turn", turns=len(st.session_state.chat.turns)):
+            try:
+                response = st.session_state.chat.send_message(prompt)
+                with span("chat.stream_render"):
+                    reply = st.write_stream(stream_text(response))
+                st.session_state.chat.record_turn(prompt, reply)
+            except Exception as e:
+                reply = f"API Call Failed: {str(e)}"
+                st.markdown(reply)
+        st.session_state.messages.append({"role": "assistant", "content": reply})
 
+if ADMIN_TOKEN and st.query_params.get("admin") == ADMIN_TOKEN:
+    render_admin_view()
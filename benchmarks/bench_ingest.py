@@ -0,0 +1,84 @@
+"""Benchmarks for the Webcam/Upload image ingest path.
+
+Run from this directory (after ``pip install -r requirements.txt``)::
+
+    pytest
+
+Each run is saved as JSON under ``.benchmarks/`` (time plus ``peak_memory_bytes`` in
+``extra_info``); compare against an earlier run with ``pytest --benchmark-compare``.
+"""
+import io
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+from conftest import IMAGE_FORMATS, IMAGE_SIZES
+from weargalaxy import imaging
+
+MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png"}
+
+def legacy_ingest(image_bytes):
+    """The original pipeline: bytearray copy, np.asarray, imdecode, BGR->RGB, PIL wrap."""
+    file_bytes = np.asarray(bytearray(image_bytes), dtype=np.uint8)
+    frame = cv2.imdecode(file_bytes, 1)
+    rgb_frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+    return Image.fromarray(rgb_frame)
+
+def frombuffer_ingest(image_bytes):
+    """The legacy pipeline without the bytearray copy and with an in-place colour swap."""
+    frame = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    return Image.fromarray(frame)
+
+def reduced_decode_ingest(image_bytes):
+    """OpenCV decoding straight to a quarter of the resolution (DCT scaling for JPEGs)."""
+    frame = cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_REDUCED_COLOR_4)
+    cv2.cvtColor(frame, cv2.COLOR_BGR2RGB, dst=frame)
+    return Image.fromarray(frame)
+
+def pil_ingest(image_bytes):
+    """A full decode with Pillow alone, skipping OpenCV and the NumPy round trip."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        return img.convert("RGB")
+
+def passthrough_ingest(image_bytes):
+    """What the app sends when no pixel work is needed: the original bytes and a MIME sniff."""
+    return {"mime_type": imaging.detect_mime_type(image_bytes), "data": image_bytes}
+
+INGEST_PIPELINES = {
+    "legacy": legacy_ingest,
+    "frombuffer": frombuffer_ingest,
+    "reduced_decode": reduced_decode_ingest,
+    "pil": pil_ingest,
+    "passthrough": passthrough_ingest,
+}
+
+size_params = pytest.mark.parametrize("size_label", [label for label, _, _ in IMAGE_SIZES])
+format_params = pytest.mark.parametrize("image_format", IMAGE_FORMATS)
+
+@size_params
+@format_params
+@pytest.mark.parametrize("pipeline", list(INGEST_PIPELINES))
+def bench_ingest(measure, encoded_images, pipeline, image_format, size_label):
+    image_bytes = encoded_images(size_label, image_format)
+    measure(INGEST_PIPELINES[pipeline], image_bytes, input_bytes=len(image_bytes))
+
+@size_params
+@format_params
+def bench_prepare_image_for_gemini(measure, encoded_images, image_format, size_label):
+    """The app's preprocessing as shipped: downscale to MAX_IMAGE_EDGE, re-encode under the byte budget."""
+    image_bytes = encoded_images(size_label, image_format)
+    measure(imaging.prepare_image_for_gemini, image_bytes, MIME_TYPES[image_format], input_bytes=len(image_bytes))
+
+@size_params
+@format_params
+def bench_prepared_analysis_input(measure, encoded_images, image_format, size_label):
+    """Everything the app does to an upload before the local engine runs: prepare, hash, decode."""
+    image_bytes = encoded_images(size_label, image_format)
+
+    def prepare_hash_decode(data):
+        prepared, _, _ = imaging.prepare_image_for_gemini(data, MIME_TYPES[image_format])
+        return imaging.perceptual_hash(prepared), imaging.decode_rgb(prepared)
+    measure(prepare_hash_decode, image_bytes, input_bytes=len(image_bytes))
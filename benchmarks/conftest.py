@@ -0,0 +1,84 @@
+import tracemalloc
+
+import cv2
+import numpy as np
+import pytest
+
+# (label, width, height) from a small webcam frame up to a 48 MP phone photo.
+IMAGE_SIZES = [
+    ("0.3MP", 640, 480),
+    ("2MP", 1600, 1200),
+    ("12MP", 4000, 3000),
+    ("48MP", 8000, 6000),
+]
+IMAGE_FORMATS = ["jpeg", "png"]
+
+def synthetic_photo(width, height, seed=0):
+    """Builds a photo-like BGR frame: smooth gradients plus sensor-style noise, so codecs behave realistically."""
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 1, width, dtype=np.float32)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    frame = np.empty((height, width, 3), dtype=np.float32)
+    frame[..., 0] = 255 * x
+    frame[..., 1] = 255 * y
+    frame[..., 2] = 127.5 * (1 + np.sin(12 * x + 8 * y))
+    frame += rng.normal(0, 6, size=(height, width, 1)).astype(np.float32)
+    return np.clip(frame, 0, 255).astype(np.uint8)
+
+@pytest.fixture(scope="session")
+def encoded_images():
+    """Encodes every size/format combination once per session (48 MP PNGs are slow to build)."""
+    cache = {}
+
+    def get(size_label, image_format):
+        key = (size_label, image_format)
+        if key not in cache:
+            _, width, height = next(size for size in IMAGE_SIZES if size[0] == size_label)
+            extension = ".jpg" if image_format == "jpeg" else ".png"
+            cache[key] = cv2.imencode(extension, synthetic_photo(width, height))[1].tobytes()
+        return cache[key]
+    return get
+
+def _read_status_kb(field):
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith(field):
+                return int(line.split()[1])
+    return None
+
+def peak_memory_bytes(fn, *args):
+    """Measures the peak extra memory of one call.
+
+    On Linux this resets the process high-water mark and reads VmHWM, which sees allocations made by
+    OpenCV and Pillow as well as NumPy. Elsewhere it falls back to tracemalloc, which only sees
+    allocations made through Python's allocator (NumPy included, Pillow's image buffers not).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        baseline_kb = _read_status_kb("VmRSS:")
+        result = fn(*args)
+        peak_kb = _read_status_kb("VmHWM:")
+        del result
+        return max(peak_kb - baseline_kb, 0) * 1024, "vmhwm"
+    except OSError:
+        tracemalloc.start()
+        try:
+            result = fn(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del result
+        return peak, "tracemalloc"
+
+@pytest.fixture
+def measure(benchmark):
+    """Benchmarks fn(*args) and attaches its peak memory and input size to the saved JSON."""
+    def run(fn, *args, input_bytes=None):
+        memory, method = peak_memory_bytes(fn, *args)
+        benchmark.extra_info["peak_memory_bytes"] = memory
+        benchmark.extra_info["peak_memory_method"] = method
+        if input_bytes is not None:
+            benchmark.extra_info["input_bytes"] = input_bytes
+        return benchmark(fn, *args)
+    return run
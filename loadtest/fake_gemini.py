@@ -0,0 +1,171 @@
+"""A local stand-in for the Gemini REST API, for load tests and offline runs.
+
+Serves ``generateContent`` and ``streamGenerateContent`` for any model with configurable latency,
+error rate and token counts. Point the app at it with::
+
+    GEMINI_API_KEY=fake GEMINI_API_ENDPOINT=http://127.0.0.1:8765 streamlit run app.py
+"""
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+ROUTE = re.compile(r"/models/(?P<model>[^/:]+):(?P<method>generateContent|streamGenerateContent)$")
+FACE_SHAPES = ["Oval", "Square", "Round", "Heart"]
+
+class FakeGeminiConfig:
+    def __init__(self, latency_ms=800, jitter_ms=200, ttfb_ms=300, error_rate=0.0, rate_limit_rate=0.0,
+                 output_tokens=40, stream_chunks=4):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.ttfb_ms = ttfb_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.output_tokens = output_tokens
+        self.stream_chunks = stream_chunks
+
+    def latency_seconds(self):
+        return max(random.gauss(self.latency_ms, self.jitter_ms), 0) / 1000
+
+class FakeGeminiStats:
+    """Thread-safe request counters, so a harness can report what the upstream actually saw."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def record(self, error):
+        with self._lock:
+            self.requests += 1
+            self.errors += int(error)
+
+def reply_text(body):
+    """Answers in the shape the app asked for: structured analysis JSON, a suggestion, or chat text."""
+    config = body.get("generationConfig") or body.get("generation_config") or {}
+    if (config.get("responseMimeType") or config.get("response_mime_type")) == "application/json":
+        return json.dumps({
+            "face_shape": random.choice(FACE_SHAPES),
+            "confidence": round(random.uniform(0.6, 0.95), 2),
+            "suggestion": "Try rectangular acetate frames with a slightly wider bridge.",
+        })
+    prompt = json.dumps(body.get("contents", []))
+    if "Suggestion" in prompt and "Summarize" not in prompt:
+        return "WeAR AI's Suggestion: Rectangular or geometric frames balance soft curves nicely."
+    return "Rectangular frames add structure, while thin metal or rimless styles keep the look light and modern."
+
+def response_chunk(text, prompt_tokens, output_tokens, finished):
+    chunk = {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}],
+        "usageMetadata": {
+            "promptTokenCount": prompt_tokens,
+            "candidatesTokenCount": output_tokens,
+            "totalTokenCount": prompt_tokens + output_tokens,
+        },
+    }
+    if finished:
+        chunk["candidates"][0]["finishReason"] = "STOP"
+    return chunk
+
+def make_handler(config, stats):
+    class FakeGeminiHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            url = urlsplit(self.path)
+            route = ROUTE.search(url.path)
+            if route is None:
+                self.send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+                return
+            raw_body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            body = json.loads(raw_body or b"{}")
+            roll = random.random()
+            if roll < config.rate_limit_rate:
+                stats.record(error=True)
+                self.send_json(429, {"error": {"code": 429, "message": "Fake quota exceeded", "status": "RESOURCE_EXHAUSTED"}})
+                return
+            if roll < config.rate_limit_rate + config.error_rate:
+                time.sleep(config.latency_seconds())
+                stats.record(error=True)
+                self.send_json(503, {"error": {"code": 503, "message": "Fake overload", "status": "UNAVAILABLE"}})
+                return
+            stats.record(error=False)
+            prompt_tokens = max(len(raw_body) // 4, 1)  # inline images are base64, so this overestimates them
+            text = reply_text(body)
+            if route["method"] == "generateContent":
+                time.sleep(config.latency_seconds())
+                self.send_json(200, response_chunk(text, prompt_tokens, config.output_tokens, finished=True))
+            else:
+                self.stream(text, prompt_tokens, sse="sse" in url.query)
+
+        def stream(self, text, prompt_tokens, sse):
+            words = text.split(" ")
+            size = max(len(words) // config.stream_chunks, 1)
+            pieces = [" ".join(words[i:i + size]) + " " for i in range(0, len(words), size)]
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream" if sse else "application/json")
+            self.end_headers()
+            time.sleep(config.ttfb_ms / 1000)
+            per_chunk = max(config.latency_seconds() - config.ttfb_ms / 1000, 0) / len(pieces)
+            if not sse:
+                self.wfile.write(b"[")
+            for index, piece in enumerate(pieces):
+                finished = index == len(pieces) - 1
+                chunk = json.dumps(response_chunk(piece, prompt_tokens, config.output_tokens if finished else 0, finished))
+                if sse:
+                    self.wfile.write(f"data: {chunk}\r\n\r\n".encode())
+                else:
+                    self.wfile.write(((",\n" if index else "") + chunk).encode())
+                self.wfile.flush()
+                if not finished:
+                    time.sleep(per_chunk)
+            if not sse:
+                self.wfile.write(b"]")
+
+        def send_json(self, status, payload):
+            data = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+    return FakeGeminiHandler
+
+def start_fake_gemini(config, host="127.0.0.1", port=0):
+    """Starts the stand-in on a background thread; returns (server, stats). Port 0 picks a free port."""
+    stats = FakeGeminiStats()
+    server = ThreadingHTTPServer((host, port), make_handler(config, stats))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="fake-gemini", daemon=True).start()
+    return server, stats
+
+def add_config_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=800, help="mean upstream latency per call")
+    parser.add_argument("--jitter-ms", type=float, default=200, help="standard deviation of the latency")
+    parser.add_argument("--ttfb-ms", type=float, default=300, help="time to first chunk for streamed calls")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of calls answered with 503")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of calls answered with 429")
+    parser.add_argument("--output-tokens", type=int, default=40, help="output tokens reported per call")
+
+def config_from_args(args):
+    return FakeGeminiConfig(
+        latency_ms=args.latency_ms, jitter_ms=args.jitter_ms, ttfb_ms=args.ttfb_ms, error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate, output_tokens=args.output_tokens,
+    )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    server, _ = start_fake_gemini(config_from_args(args), args.host, args.port)
+    print(f"Fake Gemini listening on http://{args.host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
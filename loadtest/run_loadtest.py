@@ -0,0 +1,402 @@
+"""Concurrent-session load test: N browser sessions against one `streamlit run` server process.
+
+Starts the local Gemini stand-in (fake_gemini.py) and a headless `streamlit run app.py` pointed at
+it, then connects N simulated sessions per input mode to that one server over Streamlit's own
+websocket protocol (the BackMsg/ForwardMsg protobufs a browser exchanges with /_stcore/stream).
+Every session shares the server's caches, job runner, rate limiter and GIL, as real users do.
+Reports throughput, per-mode latency percentiles and the server's peak RSS at every level::
+
+    pip install -r requirements.txt
+    python run_loadtest.py --concurrency 1,4,16 --actions 5 --latency-ms 800 --error-rate 0.02
+
+The local face engine tier is off by default, as in the app; --local-threshold enables it.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+from streamlit.proto.BackMsg_pb2 import BackMsg
+from streamlit.proto.Common_pb2 import FileURLs, UploadedFileInfo
+from streamlit.proto.ForwardMsg_pb2 import ForwardMsg
+from streamlit.proto.WidgetStates_pb2 import WidgetState
+from tornado.httpclient import AsyncHTTPClient, HTTPClient, HTTPClientError
+from tornado.websocket import websocket_connect
+
+from fake_gemini import add_config_arguments, config_from_args, start_fake_gemini
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APP_PATH = REPO_ROOT / "app.py"
+MODES = ("Webcam", "Upload Image", "Manual Input", "Chatbot")
+FACE_SHAPES = ("Oval", "Square", "Round", "Heart")
+SERVER_START_TIMEOUT_SECONDS = 60
+SERVER_STOP_TIMEOUT_SECONDS = 10
+RSS_SAMPLE_SECONDS = 0.2
+PENDING_JOB_MARKER = "⏳"  # prefixes the app's progress caption while an analysis is queued
+FAILURE_MARKER = "API Call Failed"
+CHAT_PROMPTS = (
+    "What frames suit an oval face?",
+    "Are acetate frames heavier than metal ones?",
+    "Which styles work for a round face and a small nose?",
+)
+RUN_FINISHED = {
+    ForwardMsg.FINISHED_SUCCESSFULLY, ForwardMsg.FINISHED_WITH_COMPILE_ERROR, ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY,
+}
+
+def random_photo(width=1280, height=960):
+    """A JPEG of random blocks; unique per call, so perceptual and response caches don't absorb the load."""
+    blocks = np.random.randint(0, 256, size=(height // 64, width // 64, 3), dtype=np.uint8)
+    image = Image.fromarray(blocks).resize((width, height), Image.NEAREST)
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG", quality=85)
+    return buffer.getvalue()
+
+class BrowserSession:
+    """One simulated browser tab, speaking Streamlit's websocket protocol to the server.
+
+    Like the frontend, it resends the state of every widget on each rerun, sends button clicks and
+    chat messages as one-off triggers, uploads files over HTTP before referencing them in a widget,
+    and reruns st.fragment(run_every=...) fragments on the interval the server asks for.
+    """
+    def __init__(self, base_url, timeout):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.connection = None
+        self.session_id = None
+        self.page_script_hash = ""
+        self.widgets = {}  # (element type, label or chat placeholder) -> widget id, as last rendered
+        self.widget_states = {}  # widget id -> WidgetState the session keeps resending
+        self.elements = {}  # delta path -> element, for the current script run
+        self.auto_rerun = None  # (fragment id, interval seconds) of the last st.fragment(run_every=...)
+        self.last_run_was_fragment = False
+
+    async def connect(self):
+        ws_url = self.base_url.replace("http", "ws", 1) + "/_stcore/stream"
+        self.connection = await websocket_connect(ws_url, subprotocols=["streamlit"])
+        await self.rerun()
+
+    def close(self):
+        self.connection.close()
+
+    async def _receive(self):
+        payload = await asyncio.wait_for(self.connection.read_message(), self.timeout)
+        if payload is None:
+            raise ConnectionError("the server closed the websocket")
+        msg = ForwardMsg()
+        msg.ParseFromString(payload)
+        kind = msg.WhichOneof("type")
+        if kind == "new_session":
+            self.elements = {}
+            self.page_script_hash = msg.new_session.page_script_hash
+            if msg.new_session.initialize.session_id:
+                self.session_id = msg.new_session.initialize.session_id
+        elif kind == "delta" and msg.delta.WhichOneof("type") == "new_element":
+            element = msg.delta.new_element
+            self.elements[tuple(msg.metadata.delta_path)] = element
+            kind = element.WhichOneof("type")
+            widget = getattr(element, kind)
+            if hasattr(widget, "id"):
+                self.widgets[(kind, widget.label if hasattr(widget, "label") else widget.placeholder)] = widget.id
+        elif kind == "auto_rerun":
+            self.auto_rerun = (msg.auto_rerun.fragment_id, msg.auto_rerun.interval)
+        return msg
+
+    async def _send_rerun(self, triggers=(), fragment_id=""):
+        back_msg = BackMsg()
+        client_state = back_msg.rerun_script
+        client_state.page_script_hash = self.page_script_hash
+        client_state.widget_states.widgets.extend([*self.widget_states.values(), *triggers])
+        if fragment_id:
+            client_state.fragment_id = fragment_id
+            client_state.is_auto_rerun = True
+        await self.connection.write_message(back_msg.SerializeToString(), binary=True)
+
+    async def rerun(self, triggers=(), fragment_id=""):
+        """Reruns the script (or one fragment) and returns once the run, and any rerun it asked for, ends."""
+        await self._send_rerun(triggers, fragment_id)
+        while True:
+            msg = await self._receive()
+            if msg.WhichOneof("type") == "script_finished" and msg.script_finished in RUN_FINISHED:
+                self.last_run_was_fragment = msg.script_finished == ForwardMsg.FINISHED_FRAGMENT_RUN_SUCCESSFULLY
+                return
+
+    def widget_id(self, kind, label):
+        return self.widgets[(kind, label)]
+
+    def texts(self):
+        """Markdown and caption text rendered by the current run, final streamed values included."""
+        return [element.markdown.body for element in self.elements.values() if element.WhichOneof("type") == "markdown"]
+
+    def raised(self):
+        return any(element.WhichOneof("type") == "exception" for element in self.elements.values())
+
+    async def set_value(self, kind, label, **value):
+        state = WidgetState(id=self.widget_id(kind, label), **value)
+        self.widget_states[state.id] = state
+        await self.rerun()
+
+    async def trigger(self, kind, label, **value):
+        await self.rerun([WidgetState(id=self.widget_id(kind, label), **value)])
+
+    async def upload(self, kind, label, data, name):
+        """Uploads a file the way the frontend does, then sets it as the widget's value."""
+        request = BackMsg()
+        request.file_urls_request.request_id = uuid.uuid4().hex
+        request.file_urls_request.file_names.append(name)
+        request.file_urls_request.session_id = self.session_id
+        await self.connection.write_message(request.SerializeToString(), binary=True)
+        while True:
+            msg = await self._receive()
+            if msg.WhichOneof("type") == "file_urls_response" and msg.file_urls_response.response_id == request.file_urls_request.request_id:
+                file_urls = msg.file_urls_response.file_urls[0]
+                break
+        boundary = uuid.uuid4().hex
+        body = (
+            f'--{boundary}\r\nContent-Disposition: form-data; name="file"; filename="{name}"\r\n'
+            f"Content-Type: image/jpeg\r\n\r\n"
+        ).encode() + data + f"\r\n--{boundary}--\r\n".encode()
+        await AsyncHTTPClient().fetch(
+            self.base_url + file_urls.upload_url, method="PUT", body=body,
+            headers={"Content-Type": f"multipart/form-data; boundary={boundary}"}, request_timeout=self.timeout,
+        )
+        state = WidgetState(id=self.widget_id(kind, label))
+        state.file_uploader_state_value.uploaded_file_info.append(UploadedFileInfo(
+            file_id=file_urls.file_id, name=name, size=len(data),
+            file_urls=FileURLs(file_id=file_urls.file_id, upload_url=file_urls.upload_url, delete_url=file_urls.delete_url),
+        ))
+        self.widget_states[state.id] = state
+        await self.rerun()
+
+    async def wait_for_analysis(self):
+        """Reruns the progress fragment, as the browser would, until the queued analysis is collected."""
+        while any(text.startswith(PENDING_JOB_MARKER) for text in self.texts()) and self.auto_rerun:
+            fragment_id, interval = self.auto_rerun
+            await asyncio.sleep(interval)
+            await self.rerun(fragment_id=fragment_id)
+        if self.last_run_was_fragment:
+            await self.rerun()  # the fragment only draws progress; render the page to read the result
+
+def failure_count(session):
+    return sum(FAILURE_MARKER in text for text in session.texts())
+
+async def run_action(session, mode, shared_photo):
+    """Performs one user action in `mode` and returns (seconds, failed)."""
+    failures_before = 0  # the analysis result box is rewritten by every analysis
+    if mode in ("Webcam", "Upload Image"):
+        kind, label = ("camera_input", "Webcam Capture") if mode == "Webcam" else ("file_uploader", "Choose an image...")
+        await session.upload(kind, label, shared_photo or random_photo(), "loadtest.jpg")
+        started = time.perf_counter()
+        await session.trigger("button", "Analyze Photo" if mode == "Webcam" else "Analyze Uploaded Image", trigger_value=True)
+        await session.wait_for_analysis()
+    elif mode == "Manual Input":
+        started = time.perf_counter()
+        await session.set_value("selectbox", "What is your face shape?", string_value=random.choice(FACE_SHAPES))
+    else:
+        failures_before = failure_count(session)  # earlier failed replies stay in the chat history
+        started = time.perf_counter()
+        prompt = WidgetState(id=session.widget_id("chat_input", "Ask about glasses styles..."))
+        prompt.chat_input_value.data = random.choice(CHAT_PROMPTS)
+        await session.rerun([prompt])
+    elapsed = time.perf_counter() - started
+    return elapsed, session.raised() or failure_count(session) > failures_before
+
+async def run_session(base_url, mode, actions, timeout, shared_photo):
+    """One simulated user: opens the app, picks `mode` and performs `actions` actions.
+
+    Returns the (seconds, failed) results and the wall-clock window the actions ran in, so
+    connecting isn't counted against throughput.
+    """
+    session = BrowserSession(base_url, timeout)
+    await session.connect()
+    try:
+        await session.set_value("radio", "Choose your input method:", int_value=MODES.index(mode))
+        started = time.time()
+        results = []
+        for _ in range(actions):
+            try:
+                results.append(await run_action(session, mode, shared_photo))
+            except (asyncio.TimeoutError, ConnectionError, HTTPClientError, KeyError):
+                results.append((timeout, True))  # a stuck or broken session counts as a failed action
+        return results, (started, time.time())
+    finally:
+        session.close()
+
+def rss_bytes(pid, field="VmRSS"):
+    """Resident set size of `pid` from /proc (Linux only); None where it isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith(f"{field}:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+async def sample_peak_rss(pid, stop):
+    peak = None
+    while not stop.is_set():
+        rss = rss_bytes(pid)
+        if rss is not None:
+            peak = max(peak or 0, rss)
+        await asyncio.sleep(RSS_SAMPLE_SECONDS)
+    return peak
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+async def run_level(base_url, server_pid, concurrency, args, shared_photo):
+    """Runs `concurrency` sessions per mode at once against the one server and summarizes the results."""
+    sessions = [mode for mode in args.modes for _ in range(concurrency)]
+    stop_sampling = asyncio.Event()
+    sampler = asyncio.create_task(sample_peak_rss(server_pid, stop_sampling))
+    results = await asyncio.gather(*(
+        run_session(base_url, mode, args.actions, args.timeout, shared_photo) for mode in sessions
+    ))
+    stop_sampling.set()
+    peak_rss = await sampler
+    wall = max(window[1] for _, window in results) - min(window[0] for _, window in results)
+    per_mode = {}
+    for mode, (session_results, _) in zip(sessions, results):
+        bucket = per_mode.setdefault(mode, {"latencies": [], "failures": 0})
+        for elapsed, failed in session_results:
+            bucket["latencies"].append(elapsed)
+            bucket["failures"] += int(failed)
+    total_actions = sum(len(bucket["latencies"]) for bucket in per_mode.values())
+    return {
+        "concurrency": concurrency,
+        "sessions": len(sessions),
+        "actions": total_actions,
+        "wall_seconds": wall,
+        "throughput_per_second": total_actions / wall,
+        "server_peak_rss_bytes": peak_rss,
+        "modes": {
+            mode: {
+                "actions": len(bucket["latencies"]),
+                "failures": bucket["failures"],
+                "p50_seconds": percentile(bucket["latencies"], 50),
+                "p95_seconds": percentile(bucket["latencies"], 95),
+                "p99_seconds": percentile(bucket["latencies"], 99),
+            }
+            for mode, bucket in per_mode.items()
+        },
+    }
+
+def print_level(level):
+    peak_rss = level["server_peak_rss_bytes"]
+    print(f"\nconcurrency={level['concurrency']}  sessions={level['sessions']}  actions={level['actions']}  "
+          f"throughput={level['throughput_per_second']:.2f}/s  "
+          f"server peak RSS={f'{peak_rss / 2**20:.0f} MiB' if peak_rss else 'n/a'}")
+    print(f"  {'mode':<14}{'actions':>8}{'failures':>10}{'p50 s':>9}{'p95 s':>9}{'p99 s':>9}")
+    for mode, stats in level["modes"].items():
+        print(f"  {mode:<14}{stats['actions']:>8}{stats['failures']:>10}"
+              f"{stats['p50_seconds']:>9.3f}{stats['p95_seconds']:>9.3f}{stats['p99_seconds']:>9.3f}")
+
+def app_environment(endpoint, args, workdir):
+    """Points the app at the stand-in and keeps its side effects inside `workdir`."""
+    env = {
+        **os.environ,
+        "GEMINI_API_KEY": "loadtest",
+        "GEMINI_API_ENDPOINT": endpoint,
+        "WEAR_RESPONSE_CACHE_PATH": os.path.join(workdir, "responses.sqlite3"),
+        "WEAR_RATE_LIMIT_PATH": os.path.join(workdir, "ratelimit.json"),
+        "WEAR_TRACE_PATH": os.path.join(workdir, "traces.{pid}.jsonl"),
+        "WEAR_METRICS_PORT": "0",
+    }
+    if not args.rate_limit:
+        env["WEAR_RATE_LIMIT_RPM"] = "0"
+    if args.local_threshold is not None:
+        env["WEAR_LOCAL_CONFIDENCE_THRESHOLD"] = str(args.local_threshold)
+    return env
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+def start_app_server(env, workdir):
+    """Starts `streamlit run app.py` headless on a free port; returns (process, base URL)."""
+    port = free_port()
+    log = open(os.path.join(workdir, "streamlit.log"), "wb")
+    server = subprocess.Popen(
+        [
+            sys.executable, "-m", "streamlit", "run", str(APP_PATH),
+            "--server.headless=true", "--server.address=127.0.0.1", f"--server.port={port}",
+            "--server.fileWatcherType=none", "--browser.gatherUsageStats=false",
+            # The harness uploads files without a browser's XSRF cookie.
+            "--server.enableXsrfProtection=false",
+        ],
+        cwd=REPO_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_SECONDS
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise RuntimeError(f"streamlit exited with {server.returncode}; see {log.name}")
+        try:
+            HTTPClient().fetch(base_url + "/_stcore/health", request_timeout=1)
+            return server, base_url
+        except (OSError, HTTPClientError):
+            time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError(f"streamlit did not become healthy within {SERVER_START_TIMEOUT_SECONDS}s; see {log.name}")
+
+def stop_app_server(server):
+    # Interpreter exit waits for the app's worker threads, which may still be retrying upstream calls.
+    server.terminate()
+    try:
+        server.wait(SERVER_STOP_TIMEOUT_SECONDS)
+    except subprocess.TimeoutExpired:
+        server.kill()
+        server.wait()
+
+async def run_levels(base_url, server_pid, args, upstream):
+    shared_photo = random_photo() if args.same_photo else None
+    levels = []
+    for concurrency in (int(value) for value in args.concurrency.split(",")):
+        level = await run_level(base_url, server_pid, concurrency, args, shared_photo)
+        level["upstream_requests"] = upstream.requests
+        levels.append(level)
+        print_level(level)
+    return levels
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated sessions per mode at each level")
+    parser.add_argument("--actions", type=int, default=5, help="actions per session")
+    parser.add_argument("--modes", default=",".join(MODES), help="comma-separated modes to exercise")
+    parser.add_argument("--timeout", type=float, default=120, help="seconds allowed for one server reply")
+    parser.add_argument("--same-photo", action="store_true", help="reuse one photo so the analysis caches can hit")
+    parser.add_argument("--local-threshold", type=float,
+                        help="enable the local face engine tier at this confidence threshold (0-1); off by default")
+    parser.add_argument("--rate-limit", action="store_true", help="keep the app's shared rate limiter enabled")
+    parser.add_argument("--json", help="also write the results to this JSON file")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    args.modes = [mode.strip() for mode in args.modes.split(",")]
+
+    gemini, upstream = start_fake_gemini(config_from_args(args))
+    workdir = tempfile.mkdtemp(prefix="weargalaxy-loadtest-")
+    server, base_url = start_app_server(app_environment(f"http://127.0.0.1:{gemini.server_port}", args, workdir), workdir)
+    print(f"Fake Gemini on port {gemini.server_port}; app server {base_url} (pid {server.pid}); app state in {workdir}")
+    try:
+        levels = asyncio.run(run_levels(base_url, server.pid, args, upstream))
+    finally:
+        stop_app_server(server)
+        gemini.shutdown()
+    print(f"\nUpstream saw {upstream.requests} requests ({upstream.errors} injected errors).")
+    if args.json:
+        Path(args.json).write_text(json.dumps({"args": vars(args), "levels": levels}, indent=2))
+
+if __name__ == "__main__":
+    main()
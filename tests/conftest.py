@@ -0,0 +1,3 @@
+def counter(metrics, name):
+    """Sums a counter across all its label sets in an AppMetrics snapshot."""
+    return sum(sample["value"] for sample in metrics.snapshot()["counters"] if sample["name"] == name)
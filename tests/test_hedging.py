@@ -0,0 +1,65 @@
+"""Hedger: duplicates slow calls, but never more often than its rate cap allows."""
+import asyncio
+
+from conftest import counter
+from weargalaxy.hedging import Hedger
+from weargalaxy.metrics import AppMetrics
+
+def test_hedges_stay_under_the_rate_cap():
+    metrics = AppMetrics()
+    # The 0th percentile is the fastest call seen, so every slow call wants a hedge.
+    hedger = Hedger(percentile=0, max_rate=0.25, min_samples=1, metrics=metrics)
+
+    async def fast_call():
+        return "fast"
+
+    async def slow_call():
+        await asyncio.sleep(0.02)
+        return "slow"
+
+    async def main():
+        await hedger.run(fast_call)
+        return [await hedger.run(slow_call) for _ in range(11)]
+
+    assert asyncio.run(main()) == ["slow"] * 11
+    # 12 calls at a 25% cap: the hedge budget grows by one every four calls.
+    assert counter(metrics, "hedges_fired") == 3
+
+def test_hedge_wins_when_the_primary_stalls():
+    metrics = AppMetrics()
+    hedger = Hedger(percentile=50, max_rate=1.0, min_samples=1, metrics=metrics)
+    attempts = []
+
+    async def call():
+        attempts.append(None)
+        if len(attempts) == 2:  # the primary of the second run stalls; its hedge returns at once
+            await asyncio.sleep(10)
+        return len(attempts)
+
+    async def main():
+        await hedger.run(call)
+        return await asyncio.wait_for(hedger.run(call), 1)
+
+    assert asyncio.run(main()) == 3
+    assert counter(metrics, "hedges_won") == 1
+
+def test_cancelling_the_hedger_cancels_the_primary():
+    hedger = Hedger(percentile=50, max_rate=1.0, min_samples=1)
+    cancelled = []
+
+    async def stalled():
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(None)
+            raise
+
+    async def main():
+        try:
+            await asyncio.wait_for(hedger.run(stalled), 0.01)
+        except asyncio.TimeoutError:
+            pass
+        await asyncio.sleep(0)
+
+    asyncio.run(main())
+    assert cancelled == [None]
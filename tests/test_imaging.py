@@ -0,0 +1,29 @@
+"""Preprocessing stays under the byte budget and never sends more than the original."""
+import io
+
+import numpy as np
+from PIL import Image
+
+from weargalaxy.imaging import MIN_IMAGE_EDGE, encode_under_budget, prepare_image_for_gemini
+
+def noisy_image(width, height):
+    pixels = np.random.default_rng(0).integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+    return Image.fromarray(pixels)
+
+def test_encode_shrinks_when_the_lowest_quality_is_over_budget():
+    encoded, mime_type, size = encode_under_budget(noisy_image(512, 384), "webp", 4000)
+    assert len(encoded) <= 4000
+    assert mime_type == "image/webp"
+    assert max(size) < 512
+
+def test_encode_stops_shrinking_at_the_minimum_edge():
+    _, _, size = encode_under_budget(noisy_image(512, 384), "jpeg", 10)
+    assert max(size) == MIN_IMAGE_EDGE
+
+def test_prepared_image_is_never_larger_than_the_original():
+    buffer = io.BytesIO()
+    noisy_image(2000, 1500).resize((200, 150)).resize((2000, 1500)).save(buffer, format="PNG")
+    original = buffer.getvalue()
+    sent, _, stats = prepare_image_for_gemini(original, "image/png")
+    assert len(sent) <= len(original)
+    assert stats["sent_bytes"] == len(sent)
@@ -0,0 +1,86 @@
+"""TokenBucketLimiter: shared reservations, rejections and refunds."""
+import asyncio
+import json
+
+import pytest
+
+from conftest import counter
+from weargalaxy.metrics import AppMetrics
+from weargalaxy.ratelimit import RateLimitExceeded, TokenBucketLimiter, rate_limited
+
+def levels(limiter):
+    with open(limiter.path) as state_file:
+        return json.load(state_file)["levels"]
+
+@pytest.fixture
+def limiter(tmp_path):
+    # One request per minute, so a second request has to wait for about a minute.
+    return TokenBucketLimiter(tmp_path / "ratelimit.json", 1, 6000, max_wait_seconds=120, metrics=AppMetrics())
+
+def test_reservations_drain_the_buckets(limiter):
+    assert limiter.reserve(100) == 0
+    assert levels(limiter) == pytest.approx([0, 5900], abs=0.1)
+    assert limiter.reserve(100) == pytest.approx(60, abs=0.1)
+
+def test_rejected_reservations_cost_nothing(limiter):
+    limiter.max_wait_seconds = 10
+    limiter.reserve(100)
+    with pytest.raises(RateLimitExceeded):
+        limiter.reserve(100)
+    assert levels(limiter) == pytest.approx([0, 5900], abs=0.1)
+
+def test_cancelled_wait_refunds_the_reservation(limiter):
+    async def main():
+        await limiter.acquire(100)
+        waiting = asyncio.ensure_future(limiter.acquire(100))
+        await asyncio.sleep(0.05)  # the second reservation is made and is now sleeping off the deficit
+        assert levels(limiter)[0] == pytest.approx(-1, abs=0.1)
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+
+    asyncio.run(main())  # waits for the refund, which runs on the default executor
+    requests_left, tokens_left = levels(limiter)
+    assert requests_left == pytest.approx(0, abs=0.1)
+    assert tokens_left == pytest.approx(5900, abs=50)  # tokens refill at 100/s meanwhile
+    assert counter(limiter.metrics, "rate_limit_refunds") == 1
+
+def test_cancelled_lock_wait_refunds_the_reservation(limiter):
+    fcntl = pytest.importorskip("fcntl")
+
+    async def main():
+        with open(limiter.path, "a+") as state_file:
+            fcntl.flock(state_file, fcntl.LOCK_EX)  # another process holds the bucket file
+            waiting = asyncio.ensure_future(limiter.acquire(100))
+            await asyncio.sleep(0.05)
+            waiting.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await waiting
+        await asyncio.sleep(0.2)  # the reservation lands once the lock is free, then is handed back
+
+    asyncio.run(main())
+    requests_left, tokens_left = levels(limiter)
+    assert requests_left == pytest.approx(1, abs=0.1)
+    assert tokens_left == pytest.approx(6000, abs=0.1)
+    assert counter(limiter.metrics, "rate_limit_refunds") == 1
+
+def test_calls_cancelled_after_sending_keep_their_reservation(limiter):
+    async def in_flight():
+        await asyncio.sleep(10)
+
+    async def main():
+        call = asyncio.ensure_future(rate_limited(in_flight, ["prompt"], limiter)())
+        await asyncio.sleep(0.05)
+        call.cancel()  # e.g. the deadline passed or a hedge won; Gemini already has the request
+        with pytest.raises(asyncio.CancelledError):
+            await call
+
+    asyncio.run(main())
+    assert levels(limiter)[0] == pytest.approx(0, abs=0.1)
+    assert counter(limiter.metrics, "rate_limit_refunds") == 0
+
+def test_no_limiter_leaves_calls_unwrapped():
+    async def call():
+        return "response"
+
+    assert rate_limited(call, ["prompt"], None) is call
@@ -0,0 +1,96 @@
+"""Circuit breaker state transitions and the retry loop in call_with_resilience."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+from conftest import counter
+from weargalaxy import resilience
+from weargalaxy.metrics import AppMetrics
+from weargalaxy.resilience import CircuitBreaker, CircuitOpenError, call_with_resilience
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(resilience, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    return now
+
+def open_breaker(clock, metrics=None):
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=30, metrics=metrics or AppMetrics())
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+    return breaker
+
+def test_breaker_opens_after_threshold_and_rejects(clock):
+    metrics = AppMetrics()
+    breaker = open_breaker(clock, metrics)
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    assert counter(metrics, "breaker_opened") == 1
+    assert counter(metrics, "breaker_rejections") == 1
+
+def test_half_open_admits_a_single_trial(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 30
+    breaker.before_call()  # the trial
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()  # everyone else waits for the trial's outcome
+
+def test_successful_trial_closes_the_breaker(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record_success()
+    breaker.before_call()
+    breaker.before_call()
+
+def test_failed_trial_reopens_for_a_full_reset_period(clock):
+    metrics = AppMetrics()
+    breaker = open_breaker(clock, metrics)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.record_failure()
+    assert counter(metrics, "breaker_opened") == 2
+    clock[0] += 29
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    clock[0] += 1
+    breaker.before_call()
+
+def test_abandoned_trial_lets_the_next_call_try(clock):
+    breaker = open_breaker(clock)
+    clock[0] += 30
+    breaker.before_call()
+    breaker.abandon_trial()  # e.g. the trial was cancelled before Gemini answered
+    breaker.before_call()
+
+def test_retryable_errors_are_retried(monkeypatch):
+    monkeypatch.setattr(resilience, "RETRY_BASE_DELAY_SECONDS", 0)
+    metrics = AppMetrics()
+    attempts = []
+
+    async def flaky():
+        attempts.append(None)
+        if len(attempts) < 3:
+            raise google_exceptions.ServiceUnavailable("try again")
+        return "ok"
+
+    breaker = CircuitBreaker(failure_threshold=5, reset_seconds=30)
+    assert asyncio.run(call_with_resilience(flaky, breaker, metrics=metrics)) == "ok"
+    assert len(attempts) == 3
+    assert counter(metrics, "gemini_retries") == 2
+
+def test_other_errors_are_not_retried():
+    attempts = []
+
+    async def broken():
+        attempts.append(None)
+        raise RuntimeError("bad request")
+
+    breaker = CircuitBreaker(failure_threshold=1, reset_seconds=30)
+    with pytest.raises(RuntimeError):
+        asyncio.run(call_with_resilience(broken, breaker))
+    assert len(attempts) == 1
+    breaker.before_call()  # the upstream answered, so the breaker stays closed
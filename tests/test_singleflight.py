@@ -0,0 +1,62 @@
+"""SingleFlight: identical concurrent requests share one upstream call."""
+import asyncio
+
+import pytest
+
+from conftest import counter
+from weargalaxy.metrics import AppMetrics
+from weargalaxy.singleflight import SingleFlight
+
+def test_concurrent_callers_share_one_call():
+    metrics = AppMetrics()
+    single_flight = SingleFlight(metrics)
+    calls = []
+
+    async def upstream():
+        calls.append(None)
+        await asyncio.sleep(0.01)
+        return "response"
+
+    async def main():
+        return await asyncio.gather(*(single_flight.run("key", upstream) for _ in range(3)))
+
+    assert asyncio.run(main()) == [("response", False), ("response", True), ("response", True)]
+    assert len(calls) == 1
+    assert counter(metrics, "singleflight_shared") == 2
+
+def test_finished_calls_are_not_reused():
+    single_flight = SingleFlight()
+    calls = []
+
+    async def upstream():
+        calls.append(None)
+        return len(calls)
+
+    async def main():
+        return [await single_flight.run("key", upstream), await single_flight.run("key", upstream)]
+
+    assert asyncio.run(main()) == [(1, False), (2, False)]
+
+def test_cancelled_waiter_does_not_cancel_the_shared_call():
+    single_flight = SingleFlight()
+    upstream_cancelled = []
+
+    async def upstream():
+        try:
+            await asyncio.sleep(0.05)
+        except asyncio.CancelledError:
+            upstream_cancelled.append(None)
+            raise
+        return "response"
+
+    async def main():
+        first = asyncio.ensure_future(single_flight.run("key", upstream))
+        second = asyncio.ensure_future(single_flight.run("key", upstream))
+        await asyncio.sleep(0)
+        first.cancel()  # the caller that started the call goes away, e.g. its deadline passed
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(main()) == ("response", True)
+    assert not upstream_cancelled
@@ -0,0 +1,90 @@
+"""Runs the Webcam and Upload Image analysis paths through AppTest with tracing enabled.
+
+The Gemini SDK call is patched to fail, so no network or API key is needed: the analysis ends in
+an API error, but everything before the Gemini call runs for real.
+"""
+import io
+import json
+import os
+import time
+import uuid
+from pathlib import Path
+from unittest import mock
+
+import google.generativeai as genai
+import pytest
+from PIL import Image
+from streamlit.testing.v1 import AppTest
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APP_PATH = REPO_ROOT / "app.py"
+ANALYSIS_TIMEOUT_SECONDS = 30
+OFFLINE_ERROR = "Gemini is offline in tests"
+
+class FakeUpload(io.BytesIO):
+    """Enough of Streamlit's UploadedFile (itself a BytesIO) for the app's Webcam/Upload branches."""
+    def __init__(self, data, mime_type):
+        super().__init__(data)
+        self.name = "photo"
+        self.type = mime_type
+        self.size = len(data)
+        self.file_id = uuid.uuid4().hex
+
+def photo_bytes(image_format):
+    buffer = io.BytesIO()
+    Image.new("RGB", (1280, 960), (200, 170, 150)).save(buffer, format=image_format)
+    return buffer.getvalue()
+
+@pytest.fixture(scope="module")
+def trace_path(tmp_path_factory):
+    # Module-scoped: the app's trace logger is a process-wide cache_resource bound to the first path.
+    tmp_path = tmp_path_factory.mktemp("app")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("WEAR_TRACING_ENABLED", "1")
+        patch.setenv("WEAR_TRACE_PATH", str(tmp_path / "traces.{pid}.jsonl"))
+        patch.setenv("WEAR_RESPONSE_CACHE_PATH", str(tmp_path / "responses.sqlite3"))
+        patch.setenv("WEAR_METRICS_PORT", "0")
+        patch.setenv("GEMINI_API_KEY", "test-key")
+        patch.setattr(genai.GenerativeModel, "generate_content_async",
+                      mock.Mock(side_effect=RuntimeError(OFFLINE_ERROR)))
+        patch.chdir(REPO_ROOT)  # the page loads logo.png by relative path
+        yield tmp_path / f"traces.{os.getpid()}.jsonl"  # AppTest runs the script in this process
+
+def read_spans(path, skip_bytes):
+    with open(path, "rb") as trace_file:
+        trace_file.seek(skip_bytes)
+        return [json.loads(line) for line in trace_file.read().splitlines()]
+
+@pytest.mark.parametrize("mode, widget, button, image_format, mime_type", [
+    ("Webcam", "camera_input", "Analyze Photo", "JPEG", "image/jpeg"),
+    ("Upload Image", "file_uploader", "Analyze Uploaded Image", "JPEG", "image/jpeg"),
+    ("Upload Image", "file_uploader", "Analyze Uploaded Image", "BMP", "image/bmp"),  # re-encoded via OpenCV
+])
+def test_analysis_path_is_traced(trace_path, mode, widget, button, image_format, mime_type):
+    trace_offset = trace_path.stat().st_size if trace_path.exists() else 0
+    upload = FakeUpload(photo_bytes(image_format), mime_type)
+    with mock.patch(f"streamlit.{widget}", return_value=upload):
+        app_test = AppTest.from_file(str(APP_PATH), default_timeout=ANALYSIS_TIMEOUT_SECONDS)
+        app_test.run()
+        app_test.radio[0].set_value(mode).run()
+        next(b for b in app_test.button if b.label == button).click().run()
+        deadline = time.monotonic() + ANALYSIS_TIMEOUT_SECONDS
+        while app_test.session_state["analysis_jobs"] and time.monotonic() < deadline:
+            time.sleep(0.1)
+            app_test.run()
+
+    assert not app_test.exception
+    assert not app_test.session_state["analysis_jobs"]
+    # The job reached the Gemini tier from its worker thread.
+    assert OFFLINE_ERROR in app_test.session_state["analysis_text"]
+    spans = read_spans(trace_path, trace_offset)
+    read_spans_attributes = [
+        {attribute["key"]: attribute["value"] for attribute in record["attributes"]}
+        for record in spans if record["name"] == "upload.read"
+    ]
+    assert read_spans_attributes == [{"mime_type": {"stringValue": "image/jpeg"}}]
+    assert any(record["name"] == "analysis" for record in spans)
+    assert all(
+        {"key": "service.name", "value": {"stringValue": "weargalaxy"}} in record["resource"]["attributes"]
+        for record in spans
+    )
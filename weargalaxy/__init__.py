@@ -0,0 +1 @@
+"""Non-UI building blocks of the WeAR Galaxy app, importable without running Streamlit."""
@@ -0,0 +1,78 @@
+"""Hedged requests: a duplicate call when the first one is slower than usual."""
+import asyncio
+import os
+from collections import deque
+
+import numpy as np
+
+from weargalaxy.metrics import NULL_METRICS
+
+HEDGE_PERCENTILE = float(os.getenv("WEAR_HEDGE_PERCENTILE", "95"))
+HEDGE_MAX_RATE = float(os.getenv("WEAR_HEDGE_MAX_RATE", "0.05"))
+HEDGE_MIN_SAMPLES = 20
+
+class Hedger:
+    """Fires a duplicate request when the first is slower than a latency percentile, keeping the faster one.
+
+    Only used from the shared event loop, so its state needs no lock.
+    """
+    def __init__(self, percentile, max_rate, min_samples=HEDGE_MIN_SAMPLES, window=500, metrics=NULL_METRICS):
+        self.percentile = percentile
+        self.max_rate = max_rate
+        self.min_samples = min_samples
+        self._latencies = deque(maxlen=window)
+        self._calls = 0
+        self._hedges = 0
+        self.metrics = metrics
+
+    def hedge_delay(self):
+        """Returns how long to wait before hedging, or None when hedging isn't allowed right now."""
+        if len(self._latencies) < self.min_samples or self._hedges >= self.max_rate * self._calls:
+            return None
+        return float(np.percentile(self._latencies, self.percentile))
+
+    async def run(self, make_call):
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self._calls += 1
+        delay = self.hedge_delay()
+        primary = asyncio.ensure_future(make_call())
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=delay)
+                if not done:
+                    return await self._race(primary, make_call, started)
+            try:
+                return await primary
+            finally:
+                self._latencies.append(loop.time() - started)
+        finally:
+            # asyncio.wait doesn't cancel what it waits on, so a deadline hitting us must not leak the call.
+            if not primary.done():
+                primary.cancel()
+
+    async def _race(self, primary, make_call, started):
+        loop = asyncio.get_running_loop()
+        self._hedges += 1
+        self.metrics.incr("hedges_fired")
+        hedge = asyncio.ensure_future(make_call())
+        pending = {primary, hedge}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = done.pop()
+                if winner.exception() is None or not pending:
+                    break
+        finally:
+            for task in (primary, hedge):
+                if not task.done():
+                    task.cancel()
+        elapsed = loop.time() - started
+        # The loser's latency is censored, so record what we know: it took at least this long.
+        self._latencies.append(elapsed)
+        if winner is hedge and winner.exception() is None:
+            self.metrics.incr("hedges_won")
+            # Estimated against the recent tail the primary was on course for.
+            tail_estimate = float(np.percentile(self._latencies, 99))
+            self.metrics.incr("hedge_saved_ms", int(max(tail_estimate - elapsed, 0) * 1000))
+        return winner.result()
@@ -0,0 +1,115 @@
+"""Image sniffing, preprocessing, hashing and decoding for the Webcam/Upload paths."""
+import io
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from weargalaxy.metrics import NULL_METRICS
+
+# MIME types Gemini accepts as inline image data without any conversion on our side.
+GEMINI_IMAGE_MIME_TYPES = {"image/jpeg", "image/png", "image/webp", "image/heic", "image/heif"}
+
+def detect_mime_type(image_bytes, declared_type=None):
+    """Returns the image MIME type, sniffing the magic bytes when the browser didn't send one."""
+    if image_bytes.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if image_bytes.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return "image/webp"
+    return declared_type or "application/octet-stream"
+
+# Face shape only needs a few hundred pixels, so large phone photos are shrunk before upload.
+MAX_IMAGE_EDGE = int(os.getenv("WEAR_MAX_IMAGE_EDGE", "512"))
+IMAGE_BYTE_BUDGET = int(os.getenv("WEAR_IMAGE_BYTE_BUDGET", str(150 * 1024)))
+IMAGE_FORMATS = {"jpeg": "JPEG", "webp": "WEBP"}  # WEAR_IMAGE_FORMAT value -> Pillow encoder
+IMAGE_FORMAT = os.getenv("WEAR_IMAGE_FORMAT", "jpeg").lower()
+if IMAGE_FORMAT not in IMAGE_FORMATS:
+    raise ValueError(f"WEAR_IMAGE_FORMAT must be one of {', '.join(IMAGE_FORMATS)}, got {IMAGE_FORMAT!r}")
+IMAGE_MIN_QUALITY = 40
+IMAGE_MAX_QUALITY = 90
+MIN_IMAGE_EDGE = 128  # below this, shrinking further to meet the byte budget would lose the face
+IMAGE_SHRINK_STEP = 0.75
+
+def encode_under_budget(pil_image, image_format=IMAGE_FORMAT, byte_budget=IMAGE_BYTE_BUDGET):
+    """Encodes at the highest quality that fits the byte budget, using a binary search over quality.
+
+    When even the lowest quality is over budget, the image is shrunk step by step down to
+    MIN_IMAGE_EDGE. Returns (encoded bytes, MIME type, encoded size).
+    """
+    pil_format = IMAGE_FORMATS[image_format]
+    while True:
+        best = None
+        low, high = IMAGE_MIN_QUALITY, IMAGE_MAX_QUALITY
+        while low <= high:
+            quality = (low + high) // 2
+            buffer = io.BytesIO()
+            pil_image.save(buffer, format=pil_format, quality=quality)
+            encoded = buffer.getvalue()
+            if len(encoded) <= byte_budget:
+                best = encoded
+                low = quality + 1
+            else:
+                high = quality - 1
+        if best is not None or max(pil_image.size) <= MIN_IMAGE_EDGE:
+            break
+        scale = max(IMAGE_SHRINK_STEP, MIN_IMAGE_EDGE / max(pil_image.size))
+        pil_image = pil_image.resize((max(1, round(pil_image.width * scale)), max(1, round(pil_image.height * scale))), Image.LANCZOS)
+    if best is None:
+        # Over budget even at MIN_IMAGE_EDGE; the caller decides whether this still beats the original.
+        best = encoded
+    return best, Image.MIME[pil_format], pil_image.size
+
+def prepare_image_for_gemini(image_bytes, mime_type, metrics=NULL_METRICS):
+    """Resizes an image to MAX_IMAGE_EDGE and re-encodes it under IMAGE_BYTE_BUDGET when needed."""
+    stats = {"original_bytes": len(image_bytes), "sent_bytes": len(image_bytes)}
+    try:
+        img = Image.open(io.BytesIO(image_bytes))
+    except Image.UnidentifiedImageError:
+        raise ValueError("Could not read the image. Please use a JPG or PNG file.")
+    with img:
+        stats["original_size"] = img.size
+        stats["sent_size"] = img.size
+        if max(img.size) <= MAX_IMAGE_EDGE and len(image_bytes) <= IMAGE_BYTE_BUDGET:
+            return image_bytes, mime_type, stats
+        # For JPEGs, draft() lets the decoder downscale in the DCT domain instead of decoding every pixel.
+        decode_started = time.perf_counter()
+        img.draft("RGB", (MAX_IMAGE_EDGE, MAX_IMAGE_EDGE))
+        resized = ImageOps.exif_transpose(img).convert("RGB")
+        metrics.observe("image_decode_seconds", time.perf_counter() - decode_started, {"stage": "preprocess"})
+    resized.thumbnail((MAX_IMAGE_EDGE, MAX_IMAGE_EDGE), Image.LANCZOS)
+    # A well-compressed original can beat a fresh encode, so never spend more bytes than it did.
+    sent_bytes, sent_mime, sent_size = encode_under_budget(resized, byte_budget=min(IMAGE_BYTE_BUDGET, len(image_bytes)))
+    if len(sent_bytes) >= len(image_bytes):
+        return image_bytes, mime_type, stats
+    stats["sent_bytes"] = len(sent_bytes)
+    stats["sent_size"] = sent_size
+    return sent_bytes, sent_mime, stats
+
+def format_payload_stats(stats):
+    """Describes how much upload bandwidth preprocessing saved for one request."""
+    saved = 1 - stats["sent_bytes"] / max(stats["original_bytes"], 1)
+    return (f"Sent {stats['sent_bytes'] / 1024:.0f} KB ({stats['sent_size'][0]}x{stats['sent_size'][1]}) "
+            f"of {stats['original_bytes'] / 1024:.0f} KB ({stats['original_size'][0]}x{stats['original_size'][1]}), "
+            f"{saved:.0%} saved")
+
+HASH_SIZE = 8  # 8x8 = 64-bit dHash
+
+def perceptual_hash(image_bytes):
+    """Computes a 64-bit difference hash (dHash) of an image from a tiny grayscale thumbnail."""
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        img.draft("L", (HASH_SIZE * 8, HASH_SIZE * 8))
+        thumbnail = img.convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR)
+    pixels = np.asarray(thumbnail, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), "big")
+
+def decode_rgb(image_bytes, metrics=NULL_METRICS):
+    """Decodes image bytes into an RGB NumPy array."""
+    decode_started = time.perf_counter()
+    with Image.open(io.BytesIO(image_bytes)) as img:
+        frame = np.asarray(ImageOps.exif_transpose(img).convert("RGB"))
+    metrics.observe("image_decode_seconds", time.perf_counter() - decode_started, {"stage": "landmarks"})
+    return frame
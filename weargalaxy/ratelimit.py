@@ -0,0 +1,153 @@
+"""A token-bucket rate limit for Gemini calls, shared by every process on the host."""
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from weargalaxy.metrics import NULL_METRICS
+
+# The bucket file is locked with flock on POSIX and msvcrt.locking on Windows; without either the
+# limiter can't be shared safely, and get_rate_limiter() in app.py turns it off.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+try:
+    import msvcrt
+except ImportError:
+    msvcrt = None
+FILE_LOCKING_AVAILABLE = fcntl is not None or msvcrt is not None
+
+RATE_LIMIT_PATH = os.getenv("WEAR_RATE_LIMIT_PATH", os.path.join(tempfile.gettempdir(), "weargalaxy_ratelimit.json"))
+RATE_LIMIT_RPM = float(os.getenv("WEAR_RATE_LIMIT_RPM", "60"))
+RATE_LIMIT_TPM = float(os.getenv("WEAR_RATE_LIMIT_TPM", "250000"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.getenv("WEAR_RATE_LIMIT_MAX_WAIT_SECONDS", "10"))
+CHARS_PER_TOKEN = 4  # rough estimate, avoids a count_tokens round trip before every send
+IMAGE_TOKEN_ESTIMATE = 258  # Gemini bills a small inline image as 258 tokens
+OUTPUT_TOKEN_ESTIMATE = 256
+
+def estimate_tokens(text):
+    return len(text) // CHARS_PER_TOKEN + 1
+
+def estimate_request_tokens(contents):
+    """Estimates input plus expected output tokens for a generate_content/send_message payload."""
+    if isinstance(contents, (str, dict)):
+        contents = [contents]
+    tokens = OUTPUT_TOKEN_ESTIMATE
+    for part in contents:
+        tokens += estimate_tokens(part) if isinstance(part, str) else IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+class RateLimitExceeded(Exception):
+    """Raised instead of calling Gemini when the shared quota can't admit a call soon enough."""
+    def __init__(self, wait_seconds):
+        super().__init__(f"WeAR AI is busy right now; please try again in about {wait_seconds:.0f}s.")
+        self.wait_seconds = wait_seconds
+
+class TokenBucketLimiter:
+    """Requests-per-minute and tokens-per-minute buckets shared by every process on the host.
+
+    The bucket state lives in a small JSON file guarded by an exclusive file lock, so several Streamlit
+    processes using the same API key draw from one budget. Callers reserve capacity up front (the
+    buckets may go negative), which queues them in arrival order; the wait is how long the deficit
+    takes to refill.
+    """
+    def __init__(self, path, requests_per_minute, tokens_per_minute, max_wait_seconds, metrics=NULL_METRICS):
+        self.path = path
+        self.rates = (requests_per_minute / 60, tokens_per_minute / 60)
+        self.capacities = (requests_per_minute, tokens_per_minute)
+        self.max_wait_seconds = max_wait_seconds
+        self.metrics = metrics
+
+    def reserve(self, tokens):
+        """Reserves one request and `tokens` tokens, returning how long to wait before sending."""
+        return self._update((1, tokens))
+
+    def release(self, tokens):
+        """Returns a reservation that was never used, because its call was cancelled before being sent."""
+        self._update((-1, -tokens))
+
+    def _update(self, costs):
+        with open(self.path, "a+") as state_file:
+            _lock(state_file)
+            try:
+                state_file.seek(0)
+                try:
+                    state = json.loads(state_file.read())
+                except ValueError:
+                    state = {"levels": list(self.capacities), "updated_at": time.time()}
+                now = time.time()
+                elapsed = max(now - state["updated_at"], 0)
+                levels = [
+                    min(min(level + rate * elapsed, capacity) - cost, capacity)
+                    for level, rate, capacity, cost in zip(state["levels"], self.rates, self.capacities, costs)
+                ]
+                wait_seconds = max(max(-level, 0) / rate for level, rate in zip(levels, self.rates))
+                if costs[0] > 0 and wait_seconds > self.max_wait_seconds:
+                    raise RateLimitExceeded(wait_seconds)
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write(json.dumps({"levels": levels, "updated_at": now}))
+                state_file.flush()
+            finally:
+                _unlock(state_file)
+        return wait_seconds
+
+    def refund(self, tokens):
+        """Releases a reservation from the event loop without waiting on the file lock."""
+        self.metrics.incr("rate_limit_refunds")
+        asyncio.get_running_loop().run_in_executor(None, self.release, tokens)
+
+    async def acquire(self, tokens):
+        """Reserves capacity and waits until it's available.
+
+        Cancellation before this returns hands the reservation back; once the caller has sent its
+        request the reservation stands, since Gemini counts it against the quota anyway.
+        """
+        # The file lock can block behind other processes, so it's taken off the shared event loop.
+        reservation = asyncio.ensure_future(asyncio.to_thread(self.reserve, tokens))
+        try:
+            wait_seconds = await asyncio.shield(reservation)
+        except RateLimitExceeded:
+            self.metrics.incr("rate_limit_rejections")
+            raise
+        except asyncio.CancelledError:
+            # The reservation still lands in its thread; hand it back once it has.
+            reservation.add_done_callback(
+                lambda done: None if done.cancelled() or done.exception() else self.refund(tokens)
+            )
+            raise
+        if wait_seconds > 0:
+            self.metrics.incr("rate_limit_waits")
+            try:
+                await asyncio.sleep(wait_seconds)
+            except asyncio.CancelledError:
+                self.refund(tokens)
+                raise
+
+def rate_limited(make_call, contents, limiter):
+    """Wraps make_call so every upstream attempt (including retries and hedges) draws from the limiter's quota."""
+    if limiter is None:
+        return make_call
+    tokens = estimate_request_tokens(contents)
+
+    async def call():
+        await limiter.acquire(tokens)
+        # No refund past this point: a call cancelled in flight (deadline, lost hedge) was still sent.
+        return await make_call()
+    return call
+
+def _lock(state_file):
+    if fcntl is not None:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+    else:
+        state_file.seek(0)
+        msvcrt.locking(state_file.fileno(), msvcrt.LK_LOCK, 1)  # locks the first byte, even past EOF
+
+def _unlock(state_file):
+    if fcntl is not None:
+        fcntl.flock(state_file, fcntl.LOCK_UN)
+    else:
+        state_file.seek(0)
+        msvcrt.locking(state_file.fileno(), msvcrt.LK_UNLCK, 1)
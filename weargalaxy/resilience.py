@@ -0,0 +1,103 @@
+"""Deadlines, retries with jittered backoff and a circuit breaker around Gemini calls."""
+import asyncio
+import os
+import random
+import threading
+import time
+
+from google.api_core import exceptions as google_exceptions
+
+from weargalaxy.metrics import NULL_METRICS
+from weargalaxy.ratelimit import RateLimitExceeded
+
+CALL_DEADLINE_SECONDS = float(os.getenv("WEAR_CALL_DEADLINE_SECONDS", "30"))
+CALL_MAX_RETRIES = int(os.getenv("WEAR_CALL_MAX_RETRIES", "3"))
+RETRY_BASE_DELAY_SECONDS = 0.5
+RETRY_MAX_DELAY_SECONDS = 8.0
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("WEAR_BREAKER_FAILURE_THRESHOLD", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("WEAR_BREAKER_RESET_SECONDS", "30"))
+
+RETRYABLE_ERRORS = (
+    asyncio.TimeoutError,
+    google_exceptions.TooManyRequests,
+    google_exceptions.ResourceExhausted,
+    google_exceptions.ServiceUnavailable,
+    google_exceptions.InternalServerError,
+    google_exceptions.DeadlineExceeded,
+    google_exceptions.GatewayTimeout,
+    google_exceptions.Aborted,
+)
+
+class CircuitOpenError(Exception):
+    """Raised without calling Gemini while the circuit breaker is open."""
+
+class CircuitBreaker:
+    """Fails Gemini calls fast after repeated upstream failures, then lets one trial call through."""
+    def __init__(self, failure_threshold, reset_seconds, metrics=NULL_METRICS):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self.metrics = metrics
+
+    def before_call(self):
+        with self._lock:
+            if self._opened_at is None:
+                return
+            remaining = self._opened_at + self.reset_seconds - time.monotonic()
+            if remaining <= 0 and not self._trial_in_flight:
+                self._trial_in_flight = True  # half-open: this call decides whether to close again
+                return
+        self.metrics.incr("breaker_rejections")
+        raise CircuitOpenError(
+            f"Gemini is temporarily unavailable after repeated failures; try again in {max(remaining, 1):.0f}s."
+        )
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def abandon_trial(self):
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial_in_flight or self._failures >= self.failure_threshold:
+                if self._opened_at is None or self._trial_in_flight:
+                    self.metrics.incr("breaker_opened")
+                self._opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+async def call_with_resilience(make_call, breaker, deadline_seconds=CALL_DEADLINE_SECONDS, metrics=NULL_METRICS):
+    """Awaits make_call() with an overall deadline, jittered exponential backoff and the circuit breaker.
+
+    make_call must return a fresh coroutine on every invocation so it can be retried.
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + deadline_seconds
+    for attempt in range(CALL_MAX_RETRIES + 1):
+        breaker.before_call()
+        try:
+            result = await asyncio.wait_for(make_call(), max(deadline - loop.time(), 0))
+        except RETRYABLE_ERRORS:
+            breaker.record_failure()
+            backoff = random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+            if attempt == CALL_MAX_RETRIES or loop.time() + backoff >= deadline:
+                raise
+            metrics.incr("gemini_retries")
+            await asyncio.sleep(backoff)
+        except (asyncio.CancelledError, RateLimitExceeded):
+            breaker.abandon_trial()
+            raise
+        except Exception:
+            breaker.record_success()  # a non-retryable error still means the upstream answered
+            raise
+        else:
+            breaker.record_success()
+            return result
@@ -0,0 +1,26 @@
+"""Coalescing of identical concurrent requests onto one upstream call."""
+import asyncio
+
+from weargalaxy.metrics import NULL_METRICS
+
+class SingleFlight:
+    """Lets identical concurrent requests share one upstream call and its result.
+
+    Only used from the shared event loop, so its state needs no lock.
+    """
+    def __init__(self, metrics=NULL_METRICS):
+        self._in_flight = {}  # request digest -> Task
+        self.metrics = metrics
+
+    async def run(self, key, make_call):
+        """Returns (result, shared), where shared is True when another caller's call was reused."""
+        task = self._in_flight.get(key)
+        shared = task is not None
+        if shared:
+            self.metrics.incr("singleflight_shared")
+        else:
+            task = asyncio.ensure_future(make_call())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # Shielded so one waiter timing out or going away doesn't cancel the call for the others.
+        return await asyncio.shield(task), shared